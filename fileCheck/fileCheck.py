@@ -2,32 +2,217 @@ import os
 import time
 import datetime
 import logging
+import logging.handlers
+import pickle
+import concurrent.futures
+import functools
+import re
+import sqlite3
+import sys
+import resource
+import heapq
+import select
+import struct
+import ctypes
+import ctypes.util
+import json
+import platform
+import queue
+import threading
+import http.server
 from pathlib import Path
 import argparse
 
-def parse_arguments():
+SCAN_INDEX_VERSION = 1
+
+# Linux inotify constants, see <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF
+INOTIFY_EVENT = struct.Struct('iIII')
+
+METADATA_TIME_FORMAT = "%Y-%m-%d_%H:%M:%S"
+SQLITE_HEADER = b"SQLite format 3\x00"
+QUOTED_PATH = re.compile(r"'([^']*)'")
+TOMBSTONE_PREFIX = "Removed file "
+# Suffixes of rotated logs, ".N" of RotatingFileHandler or the dates of TimedRotatingFileHandler
+NUMBERED_BACKUP = re.compile(r"^\d+$")
+DATED_BACKUP = re.compile(r"^\d{4}-\d{2}-\d{2}(_\d{2}(-\d{2}){0,2})?$")
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Options that apply to the whole process, in a config file they can only be set at the top level
+GLOBAL_OPTIONS = {"lf", "log_max_bytes", "log_rotate_when", "log_backups", "compact_log", "metrics_port",
+                  "summary_intl", "scan_workers", "io_budget", "nice", "io_class", "config"}
+# ioprio_set(2) syscall numbers, not wrapped by glibc
+IOPRIO_SYSCALLS = {"x86_64": 251, "aarch64": 30, "i686": 289, "armv7l": 314, "ppc64le": 273, "s390x": 282}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASSES = {"best-effort": (2, 7), "idle": (3, 0)}  # (class, level), best-effort at its lowest level
+# With --spread a full scan is paced to finish within this share of the interval
+SPREAD_FRACTION = 0.8
+# Stat calls charged to the rate limit at a time while a directory is listed
+STAT_CHUNK = 64
+# Bytes a log line adds on top of its message (timestamp and separator)
+LOG_LINE_OVERHEAD = 26
+# Options every watched root needs
+ROOT_REQUIRED = {"dirToW": "--directory", "exp_folder": "--expired-folder", "meta_file": "--metadata-file",
+                 "maxfileage": "--maxfileage"}
+
+def build_parser():
     parser = argparse.ArgumentParser(description='directory tree & file logging')
-    parser.add_argument("--directory", "-d", required=True, type=str, default='.',
+    parser.add_argument("--config", "-cfg", type=str, dest="config",
+                        help="JSON, TOML or YAML file declaring several directories to watch")
+    parser.add_argument("--directory", "-d", type=str,
                         dest="dirToW", help="directory to watch, specify path")
-    parser.add_argument("--log-file", "-lf", required=True, type=str, default='.',
+    parser.add_argument("--log-file", "-lf", type=str,
                         dest="lf", help="log file location with full path")
     parser.add_argument("--interval", "-i", type=int, default=60, dest="intl",
-                        help="interval for periodic checks (in seconds)")
+                        help="interval for periodic rescans (in seconds), files already seen expire on time in between")
+    parser.add_argument("--expiry-batch", "-eb", type=float, default=1.0, dest="expiry_batch",
+                        help="expiries due within this many seconds of each other are handled in one wakeup")
     parser.add_argument("--exclude-file", "-ef", type=str, dest="excl_file",
                         help="list of files or directories to exclude from fileCheck")
-    parser.add_argument("--expired-folder", "-exp", type=str, required=True, dest="exp_folder",
+    parser.add_argument("--expired-folder", "-exp", type=str, dest="exp_folder",
                         help="folder to move expired files to")
-    parser.add_argument("--metadata-file", "-meta", type=str, required=True, dest="meta_file",
+    parser.add_argument("--metadata-file", "-meta", type=str, dest="meta_file",
                         help="metadata file to help delete expired files")
-    parser.add_argument("--maxfileage", "-age", type=int, required=True, dest="maxfileage",
+    parser.add_argument("--metadata-backend", "-mb", type=str, default="text", choices=["text", "sqlite"],
+                        dest="meta_backend", help="storage format of the metadata file")
+    parser.add_argument("--maxfileage", "-age", type=int, dest="maxfileage",
                         help="The time when a file is considered aged")
+    parser.add_argument("--log-max-bytes", "-lmb", type=int, default=0, dest="log_max_bytes",
+                        help="rotate the log file once it reaches this size (in bytes)")
+    parser.add_argument("--log-rotate-when", "-lrw", type=str, dest="log_rotate_when",
+                        help="rotate the log file on a schedule instead, e.g. 'midnight' or 'H'")
+    parser.add_argument("--log-backups", "-lbk", type=int, default=5, dest="log_backups",
+                        help="number of rotated log files to keep")
+    parser.add_argument("--compact-log", action="store_true", dest="compact_log",
+                        help="drop log entries of removed files from the rotated log backups, then exit")
+    parser.add_argument("--index-file", "-idx", type=str, dest="index_file",
+                        help="persistent stat index, enables incremental scanning")
+    parser.add_argument("--scan-workers", "-sw", type=int, default=1, dest="scan_workers",
+                        help="number of threads listing directories in parallel")
+    parser.add_argument("--mode", "-m", type=str, default="poll", choices=["poll", "inotify"], dest="mode",
+                        help="poll rescans every interval, inotify reacts to filesystem events")
+    parser.add_argument("--reconcile-interval", "-ri", type=int, default=3600, dest="reconcile_intl",
+                        help="inotify mode only, how often (in seconds) to run a full safety rescan")
+    parser.add_argument("--metrics-port", "-mp", type=int, default=0, dest="metrics_port",
+                        help="serve cycle metrics on http://127.0.0.1:PORT/metrics (off by default)")
+    parser.add_argument("--summary-interval", "-si", type=int, default=300, dest="summary_intl",
+                        help="how often (in seconds) to log a JSON summary of the last cycle, 0 to turn it off")
+    parser.add_argument("--io-budget", "-iob", type=int, default=0, dest="io_budget",
+                        help="most directory listings in flight at once across all watched directories, 0 for no limit")
+    parser.add_argument("--max-stats", "-mst", type=int, default=0, dest="max_stats",
+                        help="most stat() calls per second while scanning, 0 for no limit")
+    parser.add_argument("--max-io-bytes", "-mio", type=int, default=0, dest="max_io_bytes",
+                        help="most bytes per second of metadata and log I/O, 0 for no limit")
+    parser.add_argument("--spread", "-sp", action="store_true", dest="spread",
+                        help="pace every scan over the interval instead of running it in one burst")
+    parser.add_argument("--nice", "-ni", type=int, default=0, dest="nice",
+                        help="raise the process niceness by this much at start")
+    parser.add_argument("--io-class", "-ioc", type=str, choices=sorted(IOPRIO_CLASSES), dest="io_class",
+                        help="Linux only, run with the idle or lowest best-effort I/O priority")
+    return parser
+
+def parse_arguments():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    # Without a config file the command line describes the one directory to watch
+    required = dict(ROOT_REQUIRED, lf="--log-file")
+    missing = [flag for dest, flag in required.items() if getattr(args, dest) is None]
+    if not args.config and missing:
+        parser.error(f"the following arguments are required: {', '.join(missing)}")
+    return args
+
+def load_config(config_file):
+    # Parsed by file extension, TOML needs Python 3.11+ (or tomli) and YAML needs PyYAML
+    suffix = Path(config_file).suffix.lower()
+    if suffix == ".toml":
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        with open(config_file, 'rb') as f:
+            return tomllib.load(f)
+    if suffix in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("YAML config files need PyYAML (pip install pyyaml), or use JSON or TOML")
+        with open(config_file, 'r') as f:
+            return yaml.safe_load(f) or {}
+    with open(config_file, 'r') as f:
+        return json.load(f)
+
+def apply_options(args, options, parser, source, allow_global=True):
+    # Config keys are the long option names, e.g. "metadata-file" or "metadata_file"
+    actions = {action.option_strings[0].lstrip("-").replace("-", "_"): action
+               for action in parser._actions if action.option_strings and action.dest != "help"}
+    for key, value in options.items():
+        action = actions.get(str(key).replace("-", "_"))
+        if action is None:
+            raise ValueError(f"unknown option '{key}' in {source}")
+        if not allow_global and action.dest in GLOBAL_OPTIONS:
+            raise ValueError(f"'{key}' can only be set at the top level of the config file, not in {source}")
+        if action.type is not None and value is not None:
+            value = action.type(value)
+        if action.choices and value not in action.choices:
+            raise ValueError(f"'{key}' in {source} must be one of {', '.join(action.choices)}")
+        setattr(args, action.dest, value)
+
+def root_arguments(args, parser):
+    '''
+    Reads the config file and returns (process arguments, [arguments of every root]).
+    Top-level keys apply to every root, each entry of "roots" overrides them for one directory.
+    '''
+    config = load_config(args.config)
+    if not isinstance(config, dict) or not config.get("roots"):
+        raise ValueError(f"{args.config} has no \"roots\" list")
+
+    global_args = argparse.Namespace(**vars(args))
+    apply_options(global_args, {key: value for key, value in config.items() if key != "roots"}, parser, "the top level")
+    if global_args.lf is None:
+        raise ValueError("log-file is required, on the command line or at the top level of the config file")
+
+    roots = []
+    for number, root in enumerate(config["roots"], 1):
+        root_args = argparse.Namespace(**vars(global_args))
+        apply_options(root_args, root, parser, f"root {number}", allow_global=False)
+        missing = [flag.lstrip("-") for dest, flag in ROOT_REQUIRED.items() if getattr(root_args, dest) is None]
+        if missing:
+            raise ValueError(f"root {number} is missing {', '.join(missing)}")
+        roots.append(root_args)
 
-    return parser.parse_args()
+    # Two roots writing the same state files would corrupt each other
+    for dest in ("meta_file", "index_file"):
+        paths = [str(Path(getattr(root_args, dest)).resolve()) for root_args in roots if getattr(root_args, dest)]
+        if len(paths) != len(set(paths)):
+            raise ValueError(f"every root needs its own {dest.replace('_', ' ')}")
+    return global_args, roots
 
-def configure_logging(log_file_path):
-    logging.basicConfig(filename=log_file_path, level=logging.DEBUG,
-                        format='%(asctime)s - %(message)s',
-                        filemode='a+')
+def configure_logging(log_file_path, max_bytes=0, backup_count=0, rotate_when=None):
+    if rotate_when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(log_file_path, when=rotate_when,
+                                                                 backupCount=backup_count)
+    elif max_bytes:
+        file_handler = logging.handlers.RotatingFileHandler(log_file_path, maxBytes=max_bytes,
+                                                            backupCount=backup_count)
+    else:
+        file_handler = None
+
+    if file_handler is None:
+        logging.basicConfig(filename=log_file_path, level=logging.DEBUG,
+                            format='%(asctime)s - %(message)s',
+                            filemode='a+')
+    else:
+        logging.basicConfig(handlers=[file_handler], level=logging.DEBUG,
+                            format='%(asctime)s - %(message)s')
 
     # Add a stream handler to display log messages to the console
     console_handler = logging.StreamHandler()
@@ -36,117 +221,1269 @@ def configure_logging(log_file_path):
     console_handler.setFormatter(formatter)
     logging.getLogger().addHandler(console_handler)
 
-def read_exclude_list(exclude_file):
-    exclude_list = set()
+class ExcludeMatcher:
+    """Exclusions compiled once, a trie of excluded paths plus glob patterns."""
+
+    def __init__(self, entries=(), signature=None):
+        self.trie = {}
+        self.paths = []
+        self.patterns = []
+        self.signature = signature
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+        if any(char in entry for char in "*?["):
+            self.patterns.append(glob_to_regex(entry))
+            return
+        exclude_path = Path(entry).resolve()
+        self.paths.append(exclude_path)
+        node = self.trie
+        for part in str(exclude_path).split(os.sep):
+            node = node.setdefault(part, {})
+        # An excluded directory covers everything below it
+        node[None] = True
+
+    def matches(self, file_path):
+        file_path = str(file_path)
+        node = self.trie
+        for part in file_path.split(os.sep):
+            node = node.get(part)
+            if node is None:
+                break
+            if None in node:
+                return True
+        return any(pattern.match(file_path) for pattern in self.patterns)
+
+    def __contains__(self, file_path):
+        return self.matches(file_path)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __bool__(self):
+        return bool(self.paths or self.patterns)
+
+def class_end(pattern, start):
+    # Index of the "]" closing the character class opened at start, None if it is never closed
+    end = start + 1
+    if pattern.startswith("!", end):
+        end += 1
+    if pattern.startswith("]", end):
+        end += 1
+    end = pattern.find("]", end)
+    return None if end < 0 else end
+
+def glob_to_regex(pattern):
+    # "*.tmp" matches a file name anywhere, patterns with a "/" match whole paths,
+    # "**" matches any number of directories
+    if "/" not in pattern:
+        pattern = f"**/{pattern}"
+    elif not pattern.startswith(("/", "**")):
+        pattern = f"**/{pattern}"
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            regex += "(?:/.*)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and class_end(pattern, i) is not None:
+            # Like fnmatch, only a leading "!" negates and a "]" right after it is literal,
+            # the rest is escaped except for "-" ranges. A negated class never matches "/"
+            end = class_end(pattern, i)
+            body = pattern[i + 1:end]
+            negated = body.startswith("!")
+            if negated:
+                body = body[1:]
+            body = "".join(char if char == "-" else re.escape(char) for char in body)
+            regex += f"[^/{body}]" if negated else f"[{body}]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex + r"\Z")
+
+def read_exclude_list(exclude_file, previous=None):
+    # Recompiled only when the exclude file changes, otherwise the previous matcher is reused
+    signature = None
+    if exclude_file:
+        try:
+            stats = os.stat(exclude_file)
+            signature = (stats.st_mtime_ns, stats.st_size, stats.st_ino)
+        except OSError:
+            pass
+    if previous is not None and signature is not None and previous.signature == signature:
+        return previous
+
+    exclude_list = ExcludeMatcher(signature=signature)
     if exclude_file:
         try:
             with open(exclude_file, 'r') as file:
                 for line in file:
-                    exclude_path = Path(line.strip()).resolve()
-                    exclude_list.add(exclude_path)
-                    if exclude_path.is_dir():
-                        for sub_path in exclude_path.rglob('*'):
-                            exclude_list.add(sub_path)
+                    if line.strip():
+                        exclude_list.add(line.strip())
         except Exception as e:
             print(f"Error reading exclude file: {e}")
     return exclude_list
 
-def check_files(directory_to_watch, log_file_path, exclusion_list, exp_folder, meta_file, file_timestamps, maxfileage):
+def is_excluded(full_path, exclusion_list):
+    return bool(exclusion_list) and exclusion_list.matches(full_path)
+
+def new_scan_index():
+    # dirs: directory -> mtime_ns when last listed
+    # subdirs: directory -> child directories
+    # files: directory -> {name: (inode, size, mtime)}
+    # exclusions: exclude file signature the listings were filtered with
+    return {"version": SCAN_INDEX_VERSION, "root": None, "dirs": {}, "subdirs": {}, "files": {}, "exclusions": None,
+            "dirty": False}
+
+def load_scan_index(index_file):
+    if index_file and Path(index_file).is_file():
+        try:
+            with open(index_file, 'rb') as f:
+                index = pickle.load(f)
+            if index.get("version") == SCAN_INDEX_VERSION:
+                index["dirty"] = False
+                return index
+        except Exception as e:
+            print(f"Error reading scan index: {e}")
+    return new_scan_index()
+
+def save_scan_index(index_file, index):
+    if not index_file or not index["dirty"]:
+        return
+    # Write to a temp file and swap it in so a crash never leaves a partial index
+    tmp_file = f"{index_file}.tmp"
+    try:
+        index["dirty"] = False
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, index_file)
+    except Exception as e:
+        index["dirty"] = True
+        print(f"Error writing scan index: {e}")
+
+def list_directory(directory, old_files, exclusions=None):
+    # Re-list one directory, only stat entries that are new or whose inode changed
+    files = {}
+    subdirs = []
+    stat_calls = 0
+    charged = 0
+    throttle = current_throttle()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # Charge the rate limit as the listing goes, a huge directory is paced, not burst
+            if stat_calls - charged >= STAT_CHUNK:
+                throttle.stats(stat_calls - charged)
+                charged = stat_calls
+            try:
+                if is_excluded(entry.path, exclusions):
+                    continue
+                if entry.is_dir():
+                    # Like os.walk, do not descend into symlinked directories
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                    continue
+                known = old_files.get(entry.name)
+                if known is None or known[0] != entry.inode():
+                    stat_calls += 1
+                    stats = entry.stat()
+                    known = (stats.st_ino, stats.st_size, stats.st_mtime)
+                files[entry.name] = known
+            except OSError:
+                # Entry vanished or is a broken symlink
+                continue
+    current_metrics().add_listing(stat_calls)
+    throttle.stats(stat_calls - charged)
+    return files, subdirs
+
+def scan_incremental(directory_to_watch, index, workers=1, exclusions=None, pool=None, io_budget=None,
+                     on_directory=None):
+    root = str(Path(directory_to_watch).resolve())
+    if index["root"] != root:
+        index.update(new_scan_index())
+        index["root"] = root
+
+    dirs, subdirs, files = index["dirs"], index["subdirs"], index["files"]
+    now_ns = time.time_ns()
+
+    # A changed exclude list invalidates every listing
+    exclusion_signature = getattr(exclusions, "signature", None)
+    if index.get("exclusions") != exclusion_signature:
+        dirs.clear()
+        index["exclusions"] = exclusion_signature
+        index["dirty"] = True
+
+    def refresh_directory(directory):
+        try:
+            current_metrics().add("stat_calls")
+            current_throttle().stats(1)
+            dir_mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return False, ()
+
+        if dirs.get(directory) != dir_mtime:
+            try:
+                files[directory], subdirs[directory] = list_directory(directory, files.get(directory, {}),
+                                                                      exclusions)
+            except OSError:
+                return False, ()
+            # A directory changed within the last second may change again without
+            # its mtime moving, so leave it unrecorded and re-list it next pass
+            if now_ns - dir_mtime > 1_000_000_000:
+                dirs[directory] = dir_mtime
+            else:
+                dirs.pop(directory, None)
+            index["dirty"] = True
+        return True, subdirs.get(directory, ())
+
+    seen_dirs = set()
+    for directory, exists in walk_tree(root, refresh_directory, workers, pool, io_budget, on_directory):
+        if exists:
+            seen_dirs.add(directory)
+            for name, (inode, size, mtime) in files[directory].items():
+                yield os.path.join(directory, name), mtime
+
+    # Forget directories that no longer exist
+    for directory in set(files) - seen_dirs:
+        dirs.pop(directory, None)
+        subdirs.pop(directory, None)
+        files.pop(directory, None)
+        index["dirty"] = True
+
+def walk_tree(root, list_function, workers=1, pool=None, io_budget=None, on_directory=None):
+    # Calls list_function(directory) -> (result, subdirs) for every directory below root
+    # and yields (directory, result) as soon as each listing finishes. on_directory(directory)
+    # is called right before each listing, from the thread that lists it
+    if on_directory is not None:
+        list_function = announced(list_function, on_directory)
+    if io_budget is not None:
+        list_function = budgeted(list_function, io_budget)
+    if pool is not None:
+        yield from walk_pool(root, list_function, pool)
+        return
+    if workers <= 1:
+        pending = [root]
+        while pending:
+            directory = pending.pop()
+            result, subdirs = list_function(directory)
+            pending.extend(subdirs)
+            yield directory, result
+        return
+
+    # Fan subdirectories out over a thread pool, on network filesystems each
+    # listing is dominated by round-trips so they overlap well
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        yield from walk_pool(root, list_function, pool)
+
+def walk_pool(root, list_function, pool):
+    # The pool may be shared by several roots, so each listing counts towards the caller's
+    # metrics and rate limits
+    owner = current_metrics()
+    owner_throttle = current_throttle()
+
+    def list_for_owner(directory):
+        metrics_local.metrics = owner
+        metrics_local.throttle = owner_throttle
+        return list_function(directory)
+
+    running = {pool.submit(list_for_owner, root): root}
+    while running:
+        done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            directory = running.pop(future)
+            result, subdirs = future.result()
+            for subdir in subdirs:
+                running[pool.submit(list_for_owner, subdir)] = subdir
+            yield directory, result
+
+def announced(list_function, on_directory):
+    def list_after_announcing(directory):
+        on_directory(directory)
+        return list_function(directory)
+    return list_after_announcing
+
+def budgeted(list_function, io_budget):
+    # Every listing takes a slot of the I/O budget shared by all roots
+    def list_within_budget(directory):
+        with io_budget:
+            metrics_local.io_slot = io_budget
+            try:
+                return list_function(directory)
+            finally:
+                metrics_local.io_slot = None
+    return list_within_budget
+
+def scan_directory(directory, exclusions=None):
+    # List one directory, DirEntry.stat() saves the separate resolve() and stat() per file
+    files = []
+    subdirs = []
+    charged = 0
+    throttle = current_throttle()
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                # Charge the rate limit as the listing goes, a huge directory is paced, not burst
+                if len(files) - charged >= STAT_CHUNK:
+                    throttle.stats(len(files) - charged)
+                    charged = len(files)
+                try:
+                    # Excluded files are never stat()ed and excluded directories never entered
+                    if is_excluded(entry.path, exclusions):
+                        continue
+                    if entry.is_dir():
+                        # Like os.walk, do not descend into symlinked directories
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                        continue
+                    files.append((entry.path, entry.stat().st_mtime))
+                except OSError:
+                    # Entry vanished or is a broken symlink
+                    continue
+    except OSError:
+        pass
+    current_metrics().add_listing(len(files))
+    throttle.stats(len(files) - charged)
+    return files, subdirs
+
+def scan_files(directory_to_watch, workers=1, exclusions=None, pool=None, io_budget=None, on_directory=None):
+    # Yields (path, mtime) for every file below directory_to_watch
+    root = str(Path(directory_to_watch).resolve())
+    list_function = functools.partial(scan_directory, exclusions=exclusions)
+    for directory, files in walk_tree(root, list_function, workers, pool, io_budget, on_directory):
+        yield from files
+
+def scan_tree(directory_to_watch, scan_index=None, scan_workers=1, exclusions=None, pool=None, io_budget=None,
+              on_directory=None):
+    # Incremental mode only lists changed directories, otherwise walk the whole tree
+    if scan_index is not None:
+        return scan_incremental(directory_to_watch, scan_index, scan_workers, exclusions, pool, io_budget,
+                                on_directory)
+    return scan_files(directory_to_watch, scan_workers, exclusions, pool, io_budget, on_directory)
+
+def run_cycle(args, meta_store, file_timestamps, scan_index, exclude_list, on_directory=None):
+    # One walk of the tree feeds aging detection as it streams, then stale-entry cleanup,
+    # on_directory(directory) is called before every directory of the tree is listed, for the inotify watches
+    interval = args.reconcile_intl if args.mode == "inotify" else args.intl
+    cycle_metrics = current_metrics()
+    cycle_throttle = current_throttle()
+    cycle_throttle.pace(interval, cycle_metrics.last, len(file_timestamps))
+    cycle_metrics.start_cycle(interval, args.lf)
+    scanned_files = cycle_metrics.timed_walk(scan_tree(args.dirToW, scan_index, args.scan_workers, exclude_list,
+                                                       getattr(args, "scan_pool", None),
+                                                       getattr(args, "io_slots", None), on_directory))
+    clock = time.perf_counter
+    start = clock()
+    file_timestamps.start_scan()
+    processed_files = check_files(scanned_files, args.lf, exclude_list, args.exp_folder,
+                                  meta_store, file_timestamps, args.maxfileage)
+    # The walk streams into the check, its own time is the walk's
+    cycle_metrics.add_phase("check", clock() - start - cycle_metrics.walk_seconds)
+    if scan_index is not None:
+        start = clock()
+        save_scan_index(args.index_file, scan_index)
+        cycle_metrics.add_phase("index_save", clock() - start)
+    # What is left tracked after the eviction is exactly what the walk found
+    start = clock()
+    file_timestamps.evict()
+    cycle_metrics.add_phase("evict", clock() - start)
+    start = clock()
+    delete_files(file_timestamps, args.exp_folder, meta_store, args.lf, exclude_list)
+    cycle_metrics.add_phase("cleanup", clock() - start)
+    report_memory(file_timestamps)
+    cycle_metrics.end_cycle(tracked_files=len(file_timestamps), metadata_entries=len(meta_store.entries()),
+                            **cycle_throttle.limits())
+    if getattr(args, "summary_intl", 0):
+        cycle_metrics.log_summary(args.summary_intl)
+    return processed_files
+
+def check_files(scanned_files, log_file_path, exclusion_list, exp_folder, meta_store, file_timestamps, maxfileage):
     current_time = datetime.datetime.now()
+    # Expired files recorded in the metadata store, kept current by log_created_file
+    processed_files = meta_store.entries()
 
-    # Create a set to store file paths from the metadata file
-    processed_files = set()
-    if Path(meta_file).is_file():
-        with open(meta_file, 'r') as f:
-            for line in f:
-                parts = line.strip().split(", ")
-                if len(parts) == 2:
-                    timestamp = parts[0]
-                    file_path = Path(parts[1]).resolve()
-                    processed_files.add(file_path)
-                    file_timestamps[file_path] = datetime.datetime.strptime(timestamp, "%Y-%m-%d_%H:%M:%S")
-
-    directory_to_watch_path = Path(directory_to_watch).resolve()
-
-    # Set to store files in directory
-    current_files = set()
-    for root, subdirs, files in os.walk(directory_to_watch_path):
-        for filename in files:
-            file_path = os.path.join(root, filename)
-            full_path = Path(file_path).resolve()
-            current_files.add(full_path)
-
-            if full_path not in exclusion_list:
-                stats = full_path.stat()
-                mtime = datetime.datetime.fromtimestamp(stats.st_mtime)
-                file_creation_time = file_timestamps.get(full_path, mtime)
+    for full_path, st_mtime in scanned_files:
+        if not is_excluded(full_path, exclusion_list):
+            file_creation_time = file_timestamps.see(full_path)
+            if file_creation_time is None:
+                file_creation_time = datetime.datetime.fromtimestamp(st_mtime)
                 file_timestamps[full_path] = file_creation_time
 
-                time_difference = current_time - file_creation_time
+            time_difference = current_time - file_creation_time
+
+            if int(time_difference.total_seconds()) > maxfileage and full_path not in processed_files:
+                expire_file(full_path, log_file_path, exp_folder, meta_store, file_creation_time, maxfileage)
+
+    # Write every expiry of this pass in one batch
+    meta_store.commit()
+    return processed_files
+
+class TrackedFiles:
+    """Map of file path -> first-seen time, kept compact for very large trees.
+
+    Files are grouped under their interned directory, so a directory prefix is
+    stored once however many files it holds, and times are integer epochs.
+    The low bits of each value hold the scan that last saw the file, so evicting
+    what a scan did not find needs no set of the paths it found.
+    """
+
+    __slots__ = ("dirs", "count", "scan")
+
+    SCAN_BITS = 16
+    SCAN_MASK = (1 << SCAN_BITS) - 1
+
+    def __init__(self):
+        self.dirs = {}
+        self.count = 0
+        self.scan = 0
+
+    def get(self, file_path, default=None):
+        directory, name = os.path.split(file_path)
+        value = self.dirs.get(directory, {}).get(name)
+        return default if value is None else datetime.datetime.fromtimestamp(value >> self.SCAN_BITS)
+
+    def see(self, file_path):
+        # Like get(), and marks the file as found by the running scan
+        directory, name = os.path.split(file_path)
+        names = self.dirs.get(directory)
+        value = names.get(name) if names is not None else None
+        if value is None:
+            return None
+        names[name] = value & ~self.SCAN_MASK | self.scan
+        return datetime.datetime.fromtimestamp(value >> self.SCAN_BITS)
+
+    def __setitem__(self, file_path, creation_time):
+        directory, name = os.path.split(file_path)
+        names = self.dirs.get(directory)
+        if names is None:
+            names = self.dirs[sys.intern(directory)] = {}
+        if name not in names:
+            self.count += 1
+        names[name] = int(creation_time.timestamp()) << self.SCAN_BITS | self.scan
+
+    def __contains__(self, file_path):
+        directory, name = os.path.split(file_path)
+        return name in self.dirs.get(directory, ())
+
+    def pop(self, file_path, default=None):
+        directory, name = os.path.split(file_path)
+        names = self.dirs.get(directory)
+        if names is None or name not in names:
+            return default
+        value = names.pop(name)
+        self.count -= 1
+        if not names:
+            del self.dirs[directory]
+        return datetime.datetime.fromtimestamp(value >> self.SCAN_BITS)
+
+    def remove_tree(self, directory):
+        prefix = os.path.join(directory, "")
+        for tracked_dir in [d for d in self.dirs if d == directory or d.startswith(prefix)]:
+            self.count -= len(self.dirs.pop(tracked_dir))
+
+    def start_scan(self):
+        # Every tracked file is unseen until see() or a new entry marks it. A scan that
+        # fails half way leaves older marks behind, they just stay unseen for the next one
+        self.scan = (self.scan + 1) & self.SCAN_MASK
+
+    def evict(self):
+        # Drop every file the last scan did not see
+        for directory in list(self.dirs):
+            names = self.dirs[directory]
+            for name in [name for name, value in names.items() if value & self.SCAN_MASK != self.scan]:
+                del names[name]
+                self.count -= 1
+            if not names:
+                del self.dirs[directory]
+
+    def epochs(self):
+        # Yields (directory, name, epoch) without building paths or datetimes,
+        # the directory and name are the strings the map already holds
+        for directory, names in self.dirs.items():
+            for name, value in names.items():
+                yield directory, name, value >> self.SCAN_BITS
+
+    def items(self):
+        for directory, names in self.dirs.items():
+            for name, value in names.items():
+                yield os.path.join(directory, name), datetime.datetime.fromtimestamp(value >> self.SCAN_BITS)
+
+    def __iter__(self):
+        for directory, names in self.dirs.items():
+            for name in names:
+                yield os.path.join(directory, name)
+
+    def __len__(self):
+        return self.count
+
+    def memory_usage(self):
+        # Approximate bytes held by the containers and keys, excluding shared ints
+        size = sys.getsizeof(self.dirs)
+        for directory, names in self.dirs.items():
+            size += sys.getsizeof(directory) + sys.getsizeof(names) + sum(map(sys.getsizeof, names))
+        return size
+
+def report_memory(file_timestamps):
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    logging.debug(f"Tracking {len(file_timestamps)} files in {len(file_timestamps.dirs)} directories, "
+                  f"about {file_timestamps.memory_usage() // 1024} KB, peak RSS {peak_rss} MB")
+
+class Metrics:
+    """Counters of the running cycle and the last finished one, served on /metrics.
+
+    Counters also keep a total since start, gauges describe the last finished cycle.
+    Scan threads add once per directory, so the lock stays off the per-file path.
+    """
+
+    COUNTERS = {
+        "files_scanned": "Files seen by the walk",
+        "dirs_listed": "Directories listed",
+        "stat_calls": "stat() calls issued while scanning",
+        "files_expired": "Files newly logged as expired",
+        "entries_cleaned": "Metadata entries of removed files cleaned up",
+        "metadata_bytes_read": "Bytes of metadata read",
+        "metadata_bytes_written": "Bytes of metadata written",
+        "log_bytes_written": "Bytes appended to the log file",
+        "throttle_wait_seconds": "Seconds spent waiting on the stat and I/O rate limits",
+    }
+    GAUGES = {
+        "cycle_duration_seconds": "Wall time of the last cycle",
+        "walk_duration_seconds": "Time the last cycle spent walking the tree",
+        "check_duration_seconds": "Time the last cycle spent checking file ages, without the walk feeding it",
+        "index_save_duration_seconds": "Time the last cycle spent saving the scan index",
+        "evict_duration_seconds": "Time the last cycle spent forgetting files the walk no longer found",
+        "cleanup_duration_seconds": "Time the last cycle spent cleaning up entries of removed files",
+        "cycle_lag_seconds": "How late the last cycle started against its interval",
+        "interval_seconds": "Configured time between cycles",
+        "tracked_files": "Files tracked after the last cycle",
+        "metadata_entries": "Expired files in the metadata store",
+        "last_cycle_timestamp_seconds": "Unix time the last cycle finished",
+        "stats_per_second": "stat() calls per second achieved by the last cycle",
+        "io_bytes_per_second": "Metadata and log bytes per second achieved by the last cycle",
+        "stat_limit_per_second": "stat() rate limit in force, 0 for none",
+        "io_bytes_limit_per_second": "Metadata and log byte rate limit in force, 0 for none",
+    }
+
+    # Steps of run_cycle after the walk, timed into the <phase>_duration_seconds gauges
+    PHASES = ("check", "index_save", "evict", "cleanup")
+
+    def __init__(self, root=None):
+        self.root = root
+        self.lock = threading.Lock()
+        self.current = dict.fromkeys(self.COUNTERS, 0)
+        self.totals = dict.fromkeys(self.COUNTERS, 0)
+        self.last = None
+        self.cycles = 0
+        self.cycle_start = None
+        self.previous_start = None
+        self.interval = 0
+        self.walk_seconds = 0.0
+        self.phase_seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.log_file = None
+        self.log_size = 0
+        self.last_summary = 0
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.current[name] += amount
+            self.totals[name] += amount
+
+    def add_listing(self, stat_calls):
+        with self.lock:
+            for name, amount in (("dirs_listed", 1), ("stat_calls", stat_calls)):
+                self.current[name] += amount
+                self.totals[name] += amount
+
+    def timed_walk(self, scanned_files):
+        # Passes (path, mtime) through, timing only the walk and not its consumer
+        clock = time.perf_counter
+        walk_seconds = 0.0
+        count = 0
+        iterator = iter(scanned_files)
+        try:
+            while True:
+                start = clock()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                walk_seconds += clock() - start
+                count += 1
+                yield item
+        finally:
+            self.walk_seconds += walk_seconds
+            self.add("files_scanned", count)
+
+    def add_phase(self, phase, seconds):
+        self.phase_seconds[phase] += max(0.0, seconds)
+
+    def start_cycle(self, interval, log_file=None):
+        with self.lock:
+            self.current = dict.fromkeys(self.COUNTERS, 0)
+        self.previous_start, self.cycle_start = self.cycle_start, time.time()
+        self.interval = interval
+        self.walk_seconds = 0.0
+        self.phase_seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.log_file = log_file
+        self.log_size = file_size(log_file)
+
+    def end_cycle(self, **gauges):
+        end = time.time()
+        log_size = file_size(self.log_file)
+        # A rotated log starts over, count what the new file holds
+        self.add("log_bytes_written", log_size - self.log_size if log_size >= self.log_size else log_size)
+        lag = 0.0
+        if self.previous_start is not None:
+            lag = max(0.0, self.cycle_start - (self.previous_start + self.interval))
+        duration = max(end - self.cycle_start, 1e-6)
+        with self.lock:
+            self.cycles += 1
+            io_bytes = sum(self.current[name] for name in
+                           ("metadata_bytes_read", "metadata_bytes_written", "log_bytes_written"))
+            self.current["throttle_wait_seconds"] = round(self.current["throttle_wait_seconds"], 6)
+            self.last = dict(self.current,
+                             stats_per_second=round(self.current["stat_calls"] / duration, 3),
+                             io_bytes_per_second=round(io_bytes / duration, 3),
+                             cycle_duration_seconds=round(end - self.cycle_start, 6),
+                             walk_duration_seconds=round(self.walk_seconds, 6),
+                             **{f"{phase}_duration_seconds": round(seconds, 6)
+                                for phase, seconds in self.phase_seconds.items()},
+                             cycle_lag_seconds=round(lag, 6),
+                             interval_seconds=self.interval,
+                             last_cycle_timestamp_seconds=round(end, 3),
+                             **gauges)
+        return self.last
+
+    def log_summary(self, summary_interval):
+        # One JSON line with the last cycle, at most every summary_interval seconds
+        now = time.time()
+        if self.last is None or now - self.last_summary < summary_interval:
+            return
+        self.last_summary = now
+        summary = dict(self.last, cycles=self.cycles)
+        if self.root is not None:
+            summary["root"] = self.root
+        logging.info(f"Cycle summary {json.dumps(summary, sort_keys=True)}")
+
+    def samples(self):
+        # (metric name, value) of everything this instance exposes
+        with self.lock:
+            totals = dict(self.totals)
+            last = dict(self.last) if self.last else {}
+            cycles = self.cycles
+        samples = [("filecheck_cycles_total", cycles)]
+        samples += [(f"filecheck_{name}_total", totals[name]) for name in self.COUNTERS]
+        samples += [(f"filecheck_last_cycle_{name}", last[name]) for name in self.COUNTERS if name in last]
+        samples += [(f"filecheck_{name}", last[name]) for name in self.GAUGES if name in last]
+        return samples
+
+    def render(self):
+        return render_metrics([self])
+
+def metric_families():
+    # Metric name -> (type, help text), in exposition order
+    families = {"filecheck_cycles_total": ("counter", "Cycles finished")}
+    families.update((f"filecheck_{name}_total", ("counter", description))
+                    for name, description in Metrics.COUNTERS.items())
+    families.update((f"filecheck_last_cycle_{name}", ("gauge", f"{description} in the last cycle"))
+                    for name, description in Metrics.COUNTERS.items())
+    families.update((f"filecheck_{name}", ("gauge", description)) for name, description in Metrics.GAUGES.items())
+    return families
+
+def render_metrics(instances):
+    # Prometheus text exposition format, one family block with a sample per root
+    samples = {}
+    for instance in instances:
+        labels = ""
+        if instance.root is not None:
+            root = instance.root.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            labels = f'{{root="{root}"}}'
+        for name, value in instance.samples():
+            samples.setdefault(name, []).append(f"{name}{labels} {value}")
+    lines = []
+    for name, (metric_type, description) in metric_families().items():
+        if name in samples:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"] + samples[name]
+    return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+# Every Metrics instance served on /metrics, one per root in config mode
+metrics_registry = [metrics]
+# The Metrics instance of the root the current thread works for
+metrics_local = threading.local()
+
+def current_metrics():
+    return getattr(metrics_local, "metrics", metrics)
+
+class TokenBucket:
+    """Allows rate units per second on average and bursts of up to one second's worth.
+
+    Callers take tokens after doing the work, a caller that overdraws the bucket sleeps
+    until it is paid back, so a batch bigger than the burst is still throttled correctly.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount, sleep=None):
+        # Returns how long the caller slept, sleep(seconds) does the waiting
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - amount
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            (sleep or time.sleep)(wait)
+        return wait
+
+class Throttle:
+    """Stat and metadata/log byte rate limits of one root, no limit when a rate is 0."""
+
+    def __init__(self, max_stats=0, max_io_bytes=0, spread=False):
+        self.max_stats = max_stats
+        self.max_io_bytes = max_io_bytes
+        self.spread = spread
+        self.stat_bucket = TokenBucket(max_stats) if max_stats else None
+        self.io_bucket = TokenBucket(max_io_bytes) if max_io_bytes else None
+
+    def pace(self, interval, last_cycle, tracked_files=0):
+        # Spread a full scan over the interval, sized by the stat calls of the last one
+        if not self.spread or not interval:
+            return
+        expected_stats = max(last_cycle.get("stat_calls", 0) if last_cycle else 0, tracked_files)
+        if not expected_stats:
+            return
+        rate = max(1, expected_stats / (interval * SPREAD_FRACTION))
+        if self.max_stats:
+            rate = min(rate, self.max_stats)
+        if self.stat_bucket is None:
+            self.stat_bucket = TokenBucket(rate)
+        else:
+            self.stat_bucket.rate = rate
+
+    def stats(self, count):
+        if self.stat_bucket is not None and count:
+            current_metrics().add("throttle_wait_seconds", self.stat_bucket.take(count, release_io_slot_while))
 
-                if int(time_difference.total_seconds()) > maxfileage and full_path not in processed_files:
-                    log_msg = f"File '{full_path}' has been in the directory for more than {maxfileage} seconds."
-                    logging.info(log_msg)
-                    log_created_file(full_path, log_file_path, exp_folder, meta_file, file_creation_time)
-                    processed_files.add(full_path)
+    def io_bytes(self, count):
+        if self.io_bucket is not None and count:
+            current_metrics().add("throttle_wait_seconds", self.io_bucket.take(count, release_io_slot_while))
 
-def log_created_file(file_path, lf, exp_folder, meta_file, creation_time):
+    def limits(self):
+        # Gauges of the limits in force, 0 when there is none
+        return {"stat_limit_per_second": round(self.stat_bucket.rate, 3) if self.stat_bucket else 0,
+                "io_bytes_limit_per_second": self.max_io_bytes}
+
+throttle = Throttle()
+
+def current_throttle():
+    return getattr(metrics_local, "throttle", throttle)
+
+def release_io_slot_while(seconds):
+    # Sleeps without holding a slot of the shared I/O budget, so other roots keep listing
+    io_slot = getattr(metrics_local, "io_slot", None)
+    if io_slot is not None:
+        io_slot.release()
+    try:
+        time.sleep(seconds)
+    finally:
+        if io_slot is not None:
+            io_slot.acquire()
+
+def throttle_log_record(record):
+    # Logging filter, every log line counts towards the I/O limit of the root that wrote it
+    current_throttle().io_bytes(len(record.getMessage()) + LOG_LINE_OVERHEAD)
+    return True
+
+def set_priority(nice=0, io_class=None):
+    '''
+    Lowers the CPU and I/O priority of the process, threads started afterwards inherit it.
+    ioprio_set has no glibc wrapper so it is called through syscall().
+    '''
+    if nice:
+        os.nice(nice)
+    if not io_class:
+        return
+    syscall_number = IOPRIO_SYSCALLS.get(platform.machine())
+    libc_name = ctypes.util.find_library('c')
+    if not sys.platform.startswith("linux") or syscall_number is None or libc_name is None:
+        print(f"I/O priority is not supported on {sys.platform}/{platform.machine()}, ignoring --io-class")
+        return
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    priority_class, level = IOPRIO_CLASSES[io_class]
+    if libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, 0, (priority_class << IOPRIO_CLASS_SHIFT) | level) < 0:
+        print(f"Error setting the I/O priority: {os.strerror(ctypes.get_errno())}")
+
+def file_size(file_path):
+    try:
+        return os.path.getsize(file_path) if file_path else 0
+    except OSError:
+        return 0
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics(metrics_registry).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep scrapes out of the log file
+        pass
+
+def start_metrics_server(port, address="127.0.0.1"):
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+def expire_file(full_path, log_file_path, exp_folder, meta_store, file_creation_time, maxfileage):
+    current_metrics().add("files_expired")
+    log_msg = f"File '{full_path}' has been in the directory for more than {maxfileage} seconds."
+    logging.info(log_msg)
+    log_created_file(full_path, log_file_path, exp_folder, meta_store, file_creation_time)
+
+class MetadataStore:
+    """In-memory view of the metadata file, reloaded only when it changes on disk."""
+
+    def __init__(self, meta_file):
+        self.meta_file = meta_file
+        self.cache = None
+        self.markers = {}
+        self.signature = None
+        self.pending = []
+
+    def entries(self):
+        # Maps file path -> creation time of every expired file
+        signature = self.disk_signature()
+        if self.cache is None or signature != self.signature:
+            self.cache = self.load()
+            self.signature = signature
+            # Reverse index of file path -> marker file name in the expired folder
+            self.markers = {file_path: expired_marker_name(file_path, creation_time)
+                            for file_path, creation_time in self.cache.items()}
+        return self.cache
+
+    def add(self, file_path, creation_time, marker_name=None):
+        creation_time = creation_time.replace(microsecond=0)
+        self.entries()[str(file_path)] = creation_time
+        self.markers[str(file_path)] = marker_name or expired_marker_name(file_path, creation_time)
+        self.pending.append((str(file_path), creation_time.strftime(METADATA_TIME_FORMAT)))
+
+    def marker(self, file_path):
+        self.entries()
+        return self.markers.get(str(file_path))
+
+    def commit(self):
+        if self.pending:
+            self.write(self.pending)
+            self.pending = []
+            self.signature = self.disk_signature()
+
+    def remove(self, file_paths):
+        file_paths = [str(file_path) for file_path in file_paths]
+        if not file_paths:
+            return
+        self.commit()
+        entries = self.entries()
+        for file_path in file_paths:
+            entries.pop(file_path, None)
+            self.markers.pop(file_path, None)
+        self.delete(file_paths)
+        self.signature = self.disk_signature()
+
+    def close(self):
+        self.commit()
+
+class TextMetadataStore(MetadataStore):
+    """The original flat file, one "timestamp, path" line per expired file."""
+
+    def disk_signature(self):
+        try:
+            stats = os.stat(self.meta_file)
+        except FileNotFoundError:
+            return None
+        return stats.st_mtime_ns, stats.st_size, stats.st_ino
+
+    def load(self):
+        current_metrics().add("metadata_bytes_read", file_size(self.meta_file))
+        current_throttle().io_bytes(file_size(self.meta_file))
+        return dict(read_text_metadata(self.meta_file))
+
+    def write(self, rows):
+        content = "".join(f"{timestamp}, {file_path}\n" for file_path, timestamp in rows)
+        with open(self.meta_file, 'a') as f:
+            f.write(content)
+        current_metrics().add("metadata_bytes_written", len(content))
+        current_throttle().io_bytes(len(content))
+
+    def delete(self, file_paths):
+        # Rewrite to a temp file and swap it in so a crash never truncates the metadata
+        tmp_file = f"{self.meta_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            for file_path, creation_time in self.cache.items():
+                f.write(f"{creation_time.strftime(METADATA_TIME_FORMAT)}, {file_path}\n")
+        current_metrics().add("metadata_bytes_written", file_size(tmp_file))
+        current_throttle().io_bytes(file_size(tmp_file))
+        os.replace(tmp_file, self.meta_file)
+
+class SqliteMetadataStore(MetadataStore):
+    """Metadata kept in an SQLite database in WAL mode, indexed by path."""
+
+    def __init__(self, meta_file):
+        super().__init__(meta_file)
+        migrate_text_metadata(meta_file)
+        self.conn = sqlite3.connect(meta_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS metadata "
+                          "(path TEXT PRIMARY KEY, created TEXT NOT NULL) WITHOUT ROWID")
+        self.conn.commit()
+
+    def disk_signature(self):
+        # Only changes when another connection commits
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def load(self):
+        # Bytes are counted as the size of the rows, the pages SQLite touches are not visible here
+        rows = self.conn.execute("SELECT path, created FROM metadata").fetchall()
+        rows_bytes = sum(len(file_path) + len(timestamp) for file_path, timestamp in rows)
+        current_metrics().add("metadata_bytes_read", rows_bytes)
+        current_throttle().io_bytes(rows_bytes)
+        return {file_path: datetime.datetime.strptime(timestamp, METADATA_TIME_FORMAT)
+                for file_path, timestamp in rows}
+
+    def write(self, rows):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO metadata (path, created) VALUES (?, ?)", rows)
+        rows_bytes = sum(len(file_path) + len(timestamp) for file_path, timestamp in rows)
+        current_metrics().add("metadata_bytes_written", rows_bytes)
+        current_throttle().io_bytes(rows_bytes)
+
+    def delete(self, file_paths):
+        with self.conn:
+            self.conn.executemany("DELETE FROM metadata WHERE path = ?", [(p,) for p in file_paths])
+        current_metrics().add("metadata_bytes_written", sum(map(len, file_paths)))
+        current_throttle().io_bytes(sum(map(len, file_paths)))
+
+    def close(self):
+        super().close()
+        self.conn.close()
+
+def read_text_metadata(meta_file):
+    # Yields (path, creation time) from a "timestamp, path" metadata file
+    if not Path(meta_file).is_file():
+        return
+    with open(meta_file, 'r') as f:
+        for line in f:
+            parts = line.strip().split(", ")
+            if len(parts) == 2:
+                yield parts[1], datetime.datetime.strptime(parts[0], METADATA_TIME_FORMAT)
+
+def migrate_text_metadata(meta_file):
+    # One-shot conversion of a flat metadata file, the original is kept as <meta_file>.migrated.
+    # An empty file (prepare_paths creates one) has nothing to convert, SQLite takes it as a new database
+    if not Path(meta_file).is_file() or file_size(meta_file) == 0:
+        return
+    with open(meta_file, 'rb') as f:
+        if f.read(len(SQLITE_HEADER)) == SQLITE_HEADER:
+            return
+
+    tmp_file = f"{meta_file}.tmp"
+    Path(tmp_file).unlink(missing_ok=True)
+    conn = sqlite3.connect(tmp_file)
+    with conn:
+        conn.execute("CREATE TABLE metadata (path TEXT PRIMARY KEY, created TEXT NOT NULL) WITHOUT ROWID")
+        conn.executemany("INSERT OR REPLACE INTO metadata (path, created) VALUES (?, ?)",
+                         ((file_path, creation_time.strftime(METADATA_TIME_FORMAT))
+                          for file_path, creation_time in read_text_metadata(meta_file)))
+    count = conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+    conn.close()
+
+    os.replace(meta_file, f"{meta_file}.migrated")
+    os.replace(tmp_file, meta_file)
+    logging.info(f"Migrated {count} metadata entries from {meta_file} to SQLite")
+
+def open_metadata_store(meta_file, backend="text"):
+    if backend == "sqlite":
+        return SqliteMetadataStore(meta_file)
+    return TextMetadataStore(meta_file)
+
+class InotifyWatcher:
+    """Recursive directory watcher on top of the Linux inotify syscalls.
+
+    Watches are added by add_tree, or during a scan: start_sync(), then watch_directory() for
+    every directory right before the scan lists it, then finish_sync().
+    """
+
+    def __init__(self, directory, exclusions=None):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError("inotify requires libc")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available on this platform")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.watched = set()
+        self.synced = set()
+        # Excluded directories are never walked or watched, same as in scan_directory
+        self.exclusions = exclusions
+        self.root = str(Path(directory).resolve())
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_WATCH_MASK)
+        if wd < 0:
+            print(f"Error watching {directory}: {os.strerror(ctypes.get_errno())}")
+            return
+        self.watches[wd] = directory
+
+    def add_tree(self, directory):
+        # Watch a directory and everything below it, returns the files already inside
+        found_files = []
+        if is_excluded(directory, self.exclusions):
+            return found_files
+        for root, subdirs, files in os.walk(directory):
+            self.add_watch(root)
+            subdirs[:] = [subdir for subdir in subdirs
+                          if not is_excluded(os.path.join(root, subdir), self.exclusions)]
+            found_files.extend(file_path for file_path in (os.path.join(root, filename) for filename in files)
+                               if not is_excluded(file_path, self.exclusions))
+        return found_files
+
+    def remove_tree(self, directory):
+        # Drop the watches of a directory and everything below it, a directory moved out of
+        # the tree keeps its watches and no IN_IGNORED comes to remove them
+        prefix = os.path.join(directory, "")
+        for wd, watched in list(self.watches.items()):
+            if watched == directory or watched.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def start_sync(self):
+        # Match the watches to the directories the next scan lists, without walking the tree again
+        self.watched = set(self.watches.values())
+        self.synced = set()
+
+    def watch_directory(self, directory):
+        # Called from the scan's threads before a directory is listed, so a file created
+        # in it during the scan either makes the listing or sends an event
+        self.synced.add(directory)
+        if directory not in self.watched:
+            self.add_watch(directory)
+
+    def finish_sync(self):
+        # Directories the scan no longer reaches, now excluded or gone
+        for wd, directory in list(self.watches.items()):
+            if directory not in self.synced:
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read_events(self, timeout):
+        # Yields (event, path), event is "created", "deleted" or "overflow"
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                yield "overflow", None
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF):
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                if mask & IN_ISDIR:
+                    # Files may land in a new directory before its watch is added
+                    for file_path in self.add_tree(path):
+                        yield "created", file_path
+                else:
+                    yield "created", path
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                # Watches for deleted directories are dropped by the IN_IGNORED event
+                if not mask & IN_ISDIR:
+                    yield "deleted", path
+                else:
+                    if mask & IN_MOVED_FROM:
+                        self.remove_tree(path)
+                    yield "deleted_dir", path
+
+    def close(self):
+        os.close(self.fd)
+
+def expired_marker_name(file_path, creation_time):
+    return f"{creation_time.strftime(METADATA_TIME_FORMAT)}_{Path(file_path).stem}.txt"
+
+def log_created_file(file_path, lf, exp_folder, meta_store, creation_time):
     log_message = f"File '{file_path}' added at {creation_time}"
-    log_timestamp = creation_time.strftime("%Y-%m-%d_%H:%M:%S")
 
     try:
         logging.info(log_message)
         # Copy the file to the expired files folder
-        expired_file_path = Path(exp_folder) / f"{log_timestamp}_{Path(file_path).stem}.txt"
+        marker_name = expired_marker_name(file_path, creation_time)
+        expired_file_path = Path(exp_folder) / marker_name
         Path(expired_file_path).write_text(f"{file_path}\n")
 
-        # Write to metadata file
-        with open(meta_file, 'a') as f:
-            f.write(f"{log_timestamp}, {file_path}\n")
+        # Record in the metadata store, written out by the next commit
+        meta_store.add(file_path, creation_time, marker_name)
 
     except Exception as e:
         print(f"Error logging message: {e}")
 
-def delete_files(directory_to_watch, exp_folder, meta_file, log_file):
-    checked_files = set()
-    for root, subdirs, files in os.walk(directory_to_watch):
-        for filename in files:
-            file_path = os.path.join(root, filename)
-            checked_files.add(Path(file_path).resolve())
-
-    # Update metadata file to remove entries for files no longer in directory
-    if Path(meta_file).is_file():
-        with open(meta_file, 'r') as f:
-            lines = f.readlines()
-        with open(meta_file, 'w') as f:
-            for line in lines:
-                file_path = Path(line.strip().split(", ")[1])
-                if file_path.resolve() in checked_files:
-                    f.write(line)
-                else:
-                    # Remove the file from expired folder
-                    expired_files = os.listdir(exp_folder)
-                    for expired_file in expired_files:
-                        expired_file_path = os.path.join(exp_folder, expired_file)
-                        if os.path.isfile(expired_file_path):
-                            with open(expired_file_path, 'r') as ef:
-                                expired_content = ef.read().strip()
-                            if expired_content == str(file_path):
-                                os.remove(expired_file_path)
-                                logging.info(f"Deleted expired file: {expired_file_path}")
-
-                    # Remove entry from log file
-                    if Path(log_file).is_file():
-                        with open(log_file, 'r') as lf:
-                            log_lines = lf.readlines()
-                        with open(log_file, 'w') as lf:
-                            for log_line in log_lines:
-                                if str(file_path) not in log_line:
-                                    lf.write(log_line)
+def delete_files(present_files, exp_folder, meta_store, log_file, exclusion_list=None):
+    # Collect every metadata entry for files no longer in directory, excluded
+    # subtrees are never scanned so their entries are left alone
+    removed_files = [file_path for file_path in meta_store.entries()
+                     if file_path not in present_files and not is_excluded(file_path, exclusion_list)]
+    if not removed_files:
+        return
+    current_metrics().add("entries_cleaned", len(removed_files))
 
-def main():
-    args = parse_arguments()
+    # Remove their markers from the expired folder
+    for file_path in removed_files:
+        marker_name = meta_store.marker(file_path)
+        if marker_name is None:
+            continue
+        expired_file_path = os.path.join(exp_folder, marker_name)
+        try:
+            with open(expired_file_path, 'r') as ef:
+                expired_content = ef.read().strip()
+        except OSError:
+            continue
+        # Two files with the same name expiring in the same second share a marker
+        if expired_content == str(file_path):
+            os.remove(expired_file_path)
+            logging.info(f"Deleted expired file: {expired_file_path}")
+
+    # Append a tombstone instead of rewriting the log, --compact-log drops the old entries
+    for file_path in removed_files:
+        logging.info(f"{TOMBSTONE_PREFIX}'{file_path}'")
+    meta_store.remove(removed_files)
+
+def log_segments(log_file):
+    # The log file and its rotated backups, oldest first. Only the suffixes the log handlers
+    # produce count, other files next to the log (an index, a ".tmp") are left alone
+    log_path = Path(log_file)
+    numbered = []
+    dated = []
+    for path in log_path.parent.glob(f"{log_path.name}.*"):
+        suffix = path.name[len(log_path.name) + 1:]
+        if NUMBERED_BACKUP.match(suffix):
+            numbered.append((-int(suffix), path))  # .1 is the newest
+        elif DATED_BACKUP.match(suffix):
+            dated.append((suffix, path))
+    backups = [path for key, path in sorted(numbered)] + [path for key, path in sorted(dated)]
+    return backups + [log_path] if log_path.is_file() else backups
+
+def compact_log(log_file, attempts=3):
+    '''
+    Drops tombstones and the entries of removed files logged before them from the rotated
+    backups of log_file. The live log is only read, the daemon may be appending to it,
+    its entries are compacted once it has been rotated. A rotation while compacting starts
+    it over. Returns the number of lines dropped.
+    '''
+    dropped = 0
+    for attempt in range(attempts):
+        pass_dropped, rotated = compact_segments(log_file)
+        dropped += pass_dropped
+        if not rotated:
+            break
+        print(f"{log_file} was rotated during compaction, starting over")
+    return dropped
+
+def segment_identity(stats):
+    return stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime_ns
 
+def compact_segments(log_file):
+    # One compaction pass, returns (lines dropped, whether the log rotated meanwhile).
+    # A backup is only replaced while its name still points to the file that was read
+    segments = log_segments(log_file)
+
+    # First pass, find where each removed file was last tombstoned
+    tombstones = {}
+    identities = []
+    for segment_number, segment in enumerate(segments):
+        with open(segment, 'r') as lf:
+            identities.append(segment_identity(os.fstat(lf.fileno())))
+            for line_number, log_line in enumerate(lf):
+                if TOMBSTONE_PREFIX in log_line:
+                    for file_path in QUOTED_PATH.findall(log_line):
+                        tombstones[file_path] = (segment_number, line_number)
+    if not tombstones:
+        return 0, False
+
+    # Second pass, drop tombstones and every entry logged before them
+    dropped = 0
+    for segment_number, segment in enumerate(segments):
+        if segment == Path(log_file):
+            continue
+        try:
+            with open(segment, 'r') as lf:
+                if segment_identity(os.fstat(lf.fileno())) != identities[segment_number]:
+                    return dropped, True
+                log_lines = lf.readlines()
+        except FileNotFoundError:
+            return dropped, True
+        kept_lines = []
+        for line_number, log_line in enumerate(log_lines):
+            position = (segment_number, line_number)
+            if not any(tombstones.get(file_path, (-1, -1)) >= position for file_path in QUOTED_PATH.findall(log_line)):
+                kept_lines.append(log_line)
+        if len(kept_lines) == len(log_lines):
+            continue
+        # Swap in a rewritten copy so a crash never leaves a truncated backup
+        tmp_file = f"{segment}.tmp"
+        with open(tmp_file, 'w') as lf:
+            lf.writelines(kept_lines)
+        try:
+            rotated = segment_identity(os.stat(segment)) != identities[segment_number]
+        except FileNotFoundError:
+            rotated = True
+        if rotated:
+            os.remove(tmp_file)
+            return dropped, True
+        os.replace(tmp_file, segment)
+        dropped += len(log_lines) - len(kept_lines)
+    return dropped, False
+
+def prepare_paths(args):
     # Ensure the directories and files specified in arguments exist
     Path(args.dirToW).mkdir(parents=True, exist_ok=True)
     Path(args.exp_folder).mkdir(parents=True, exist_ok=True)
@@ -159,25 +1496,217 @@ def main():
     Path(args.meta_file).parent.mkdir(parents=True, exist_ok=True)
     Path(args.meta_file).touch(exist_ok=True)
 
+def main():
+    args = parse_arguments()
+    roots = [args]
+    if args.config:
+        try:
+            args, roots = root_arguments(args, build_parser())
+        except (OSError, ValueError) as e:
+            sys.exit(f"Error reading config file {args.config}: {e}")
+
+    for root_args in roots:
+        prepare_paths(root_args)
+
+    if args.compact_log:
+        dropped = compact_log(args.lf)
+        print(f"Dropped {dropped} log entries of removed files")
+        return
+
     # Configure logging, logs are appended to a file
-    configure_logging(args.lf)
+    configure_logging(args.lf, args.log_max_bytes, args.log_backups, args.log_rotate_when)
+    if any(getattr(root_args, "max_io_bytes", 0) for root_args in roots):
+        logging.getLogger().addFilter(throttle_log_record)
+    # Before any thread starts, so they all inherit it
+    set_priority(args.nice, args.io_class)
 
-    # Initial check for existing files
-    file_timestamps = {}
-    exclude_list = read_exclude_list(args.excl_file)
-    check_files(args.dirToW, args.lf, exclude_list, args.exp_folder, args.meta_file, file_timestamps, args.maxfileage)
-    print(f"Log file path: {args.lf}")
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+        print(f"Serving metrics on http://127.0.0.1:{args.metrics_port}/metrics")
 
+    # Directory listings of every root share this many slots
+    io_slots = threading.BoundedSemaphore(args.io_budget) if args.io_budget > 0 else None
     try:
-        while True:
-            # Periodic check, specify in argument, default 60 seconds
-            time.sleep(args.intl)
-            exclude_list = read_exclude_list(args.excl_file)
-            check_files(args.dirToW, args.lf, exclude_list, args.exp_folder, args.meta_file, file_timestamps, args.maxfileage)
-            delete_files(args.dirToW, args.exp_folder, args.meta_file, args.lf)
-            print("another loop")
+        if args.config:
+            watch_roots(args, roots, io_slots)
+        else:
+            args.io_slots = io_slots
+            watch_root(args)
     except KeyboardInterrupt:
         pass
 
+def watch_root(args):
+    metrics_local.throttle = Throttle(args.max_stats, args.max_io_bytes, args.spread)
+    meta_store = open_metadata_store(args.meta_file, args.meta_backend)
+    try:
+        if args.mode == "inotify":
+            watch_inotify(args, meta_store)
+        else:
+            watch_poll(args, meta_store)
+    finally:
+        meta_store.close()
+
+def watch_roots(args, roots, io_slots=None):
+    '''
+    Watches every root of the config file from one process, each on its own thread with
+    its own schedule, metadata store and metrics. Scans share one pool of scan-workers
+    threads and the I/O budget. Returns only by raising the error of a failed root.
+    '''
+    scan_pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.scan_workers) if args.scan_workers > 1 else None
+    failures = queue.Queue()
+    metrics_registry[:] = []
+
+    def run_root(root_args, root_metrics):
+        metrics_local.metrics = root_metrics
+        try:
+            watch_root(root_args)
+        except BaseException as e:
+            failures.put((root_args.dirToW, e))
+
+    for root_args in roots:
+        root_args.scan_pool = scan_pool
+        root_args.io_slots = io_slots
+        root_metrics = Metrics(root=str(root_args.dirToW))
+        metrics_registry.append(root_metrics)
+        threading.Thread(target=run_root, args=(root_args, root_metrics), name=f"root {root_args.dirToW}",
+                         daemon=True).start()
+    print(f"Watching {len(roots)} directories")
+
+    # The process exits with the first failing root, so systemd restarts all of them
+    directory, error = failures.get()
+    logging.error(f"Stopped watching {directory}: {error}")
+    raise error
+
+def watch_poll(args, meta_store):
+    # Stat index persisted between runs, only used in incremental mode
+    scan_index = load_scan_index(args.index_file) if args.index_file else None
+
+    file_timestamps = TrackedFiles()
+    exclude_list = None
+    expiry_queue = []
+    next_scan = 0
+    print(f"Log file path: {args.lf}")
+
+    while True:
+        now = time.time()
+        exclude_list = read_exclude_list(args.excl_file, exclude_list)
+        if now >= next_scan:
+            # Rescan on the interval, specify in argument, default 60 seconds
+            processed_files = run_cycle(args, meta_store, file_timestamps, scan_index, exclude_list)
+            next_scan = now + args.intl
+            expiry_queue = schedule_expiries(file_timestamps, processed_files, args.maxfileage, next_scan)
+            print("another loop")
+
+        # In between scans only wake up when known files are due
+        expire_due(expiry_queue, file_timestamps, processed_files, exclude_list, args, meta_store, now)
+        time.sleep(max(0, next_wakeup(expiry_queue, next_scan, args.expiry_batch) - time.time()))
+
+def schedule_expiries(file_timestamps, processed_files, maxfileage, until=None):
+    '''
+    Min-heap of (expiry epoch, directory, name) for every tracked file not yet expired
+    that is due before until, the next rescan. That rescan schedules the later ones again,
+    and the entries share the directory and name strings of file_timestamps.
+    '''
+    expiry_queue = []
+    for directory, name, epoch in file_timestamps.epochs():
+        expiry = epoch + maxfileage + 1
+        if until is not None and expiry > until:
+            continue
+        if os.path.join(directory, name) not in processed_files:
+            expiry_queue.append((expiry, directory, name))
+    heapq.heapify(expiry_queue)
+    return expiry_queue
+
+def expire_due(expiry_queue, file_timestamps, processed_files, exclude_list, args, meta_store, now):
+    # Expire every file whose deadline has passed, written to the metadata store in one batch
+    expired = 0
+    while expiry_queue and expiry_queue[0][0] <= now:
+        expiry, directory, name = heapq.heappop(expiry_queue)
+        full_path = os.path.join(directory, name)
+        file_creation_time = file_timestamps.get(full_path)
+        if file_creation_time is None or full_path in processed_files or is_excluded(full_path, exclude_list):
+            continue
+        if int((datetime.datetime.now() - file_creation_time).total_seconds()) > args.maxfileage:
+            # In poll mode the file may have been removed since the last rescan, one stat saves a false expiry
+            if not os.path.lexists(full_path):
+                file_timestamps.pop(full_path)
+                continue
+            expire_file(full_path, args.lf, args.exp_folder, meta_store, file_creation_time, args.maxfileage)
+            expired += 1
+        else:
+            heapq.heappush(expiry_queue, (expiry + 1, directory, name))
+    if expired:
+        meta_store.commit()
+    return expired
+
+def next_wakeup(expiry_queue, deadline, batch_window=0):
+    '''
+    Time to wake up at, the next expiry or the deadline (next scan or reconciliation).
+    Expiries due within batch_window of the first one wait for the last of them,
+    so a burst of files is expired in one wakeup, never early.
+    '''
+    if not expiry_queue or expiry_queue[0][0] >= deadline:
+        return deadline
+    first = expiry_queue[0][0]
+    # Pop the expiries inside the window to find the last one, then put them back
+    batch = []
+    while expiry_queue and expiry_queue[0][0] <= first + batch_window and len(batch) < 1000:
+        batch.append(heapq.heappop(expiry_queue))
+    for item in batch:
+        heapq.heappush(expiry_queue, item)
+    return min(batch[-1][0] if batch else first, deadline)
+
+def watch_inotify(args, meta_store):
+    try:
+        watcher = InotifyWatcher(args.dirToW)
+    except OSError as e:
+        print(f"Error starting inotify, falling back to polling: {e}")
+        return watch_poll(args, meta_store)
+
+    scan_index = load_scan_index(args.index_file) if args.index_file else None
+    file_timestamps = TrackedFiles()
+    print(f"Log file path: {args.lf}")
+
+    try:
+        next_reconcile = 0
+        exclude_list = None
+        while True:
+            now = time.time()
+            exclude_list = read_exclude_list(args.excl_file, exclude_list)
+            watcher.exclusions = exclude_list
+            if now >= next_reconcile:
+                # Safety rescan, catches anything the event stream missed, and watches every directory it lists
+                watcher.start_sync()
+                processed_files = run_cycle(args, meta_store, file_timestamps, scan_index, exclude_list,
+                                            watcher.watch_directory)
+                watcher.finish_sync()
+                next_reconcile = now + args.reconcile_intl
+                expiry_queue = schedule_expiries(file_timestamps, processed_files, args.maxfileage, next_reconcile)
+                print("reconciled")
+
+            # Expire every file whose deadline has passed
+            expire_due(expiry_queue, file_timestamps, processed_files, exclude_list, args, meta_store, now)
+
+            # Sleep until the next event, expiry deadline or reconciliation
+            timeout = next_wakeup(expiry_queue, next_reconcile, args.expiry_batch) - time.time()
+            for event, path in watcher.read_events(max(timeout, 0)):
+                if event == "overflow":
+                    next_reconcile = 0
+                elif event == "created":
+                    if path in file_timestamps or is_excluded(path, exclude_list):
+                        continue
+                    try:
+                        st_mtime = os.stat(path).st_mtime
+                    except OSError:
+                        continue
+                    file_timestamps[path] = datetime.datetime.fromtimestamp(st_mtime)
+                    heapq.heappush(expiry_queue, (st_mtime + args.maxfileage + 1, *os.path.split(path)))
+                elif event == "deleted":
+                    file_timestamps.pop(path)
+                elif event == "deleted_dir":
+                    file_timestamps.remove_tree(path)
+    finally:
+        watcher.close()
+
 if __name__ == "__main__":
     main()
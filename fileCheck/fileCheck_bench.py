@@ -0,0 +1,372 @@
+'''
+This is a benchmark for fileCheck.py
+It builds a synthetic directory tree in a temp directory and times the daemon's own
+run_cycle (plus re-reading the exclude list) over several cycles, with files removed
+and created between cycles. The time of every step of the cycle (walk, check, index save,
+evict, cleanup) and the counters come from the Metrics that run_cycle records,
+so the benchmark measures exactly what production runs. Every phase reports its wall time,
+CPU time, system calls and peak memory, the results are saved as JSON so two
+versions of fileCheck.py can be compared with --compare.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import datetime
+import platform
+import resource
+import tempfile
+import argparse
+import functools
+import subprocess
+from pathlib import Path
+import fileCheck
+from fileCheck import (read_exclude_list, run_cycle, new_scan_index, open_metadata_store, current_metrics,
+                       metrics_local, Throttle, TrackedFiles, METADATA_TIME_FORMAT)
+
+BENCH_FORMAT_VERSION = 2
+# Steps of run_cycle timed by its Metrics, reported next to the measured phases
+CYCLE_STEPS = ("walk",) + fileCheck.Metrics.PHASES
+MAX_FILE_AGE = 3600
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='fileCheck benchmark on a synthetic directory tree')
+    parser.add_argument("--files", "-f", type=int, default=10000, dest="files",
+                        help="number of files in the tree")
+    parser.add_argument("--depth", "-dp", type=int, default=3, dest="depth",
+                        help="directory levels below the root")
+    parser.add_argument("--fanout", "-fo", type=int, default=4, dest="fanout",
+                        help="subdirectories per directory")
+    parser.add_argument("--churn", "-c", type=float, default=0.05, dest="churn",
+                        help="fraction of files removed and created between cycles")
+    parser.add_argument("--exclude-ratio", "-er", type=float, default=0.1, dest="exclude_ratio",
+                        help="fraction of directories listed in the exclude file")
+    parser.add_argument("--aged-ratio", "-ar", type=float, default=0.5, dest="aged_ratio",
+                        help="fraction of files older than the max file age")
+    parser.add_argument("--metadata-entries", "-me", type=int, default=1000, dest="metadata_entries",
+                        help="entries of already removed files in the metadata file")
+    parser.add_argument("--log-lines", "-ll", type=int, default=10000, dest="log_lines",
+                        help="lines already in the log file")
+    parser.add_argument("--metadata-backend", "-mb", type=str, default="text", choices=["text", "sqlite"],
+                        dest="meta_backend", help="storage format of the metadata file")
+    parser.add_argument("--scan-workers", "-sw", type=int, default=1, dest="scan_workers",
+                        help="number of threads listing directories in parallel")
+    parser.add_argument("--incremental", "-inc", action="store_true", dest="incremental",
+                        help="keep a stat index between cycles, like --index-file")
+    parser.add_argument("--max-stats", "-mst", type=int, default=0, dest="max_stats",
+                        help="stat() rate limit, like fileCheck.py --max-stats")
+    parser.add_argument("--max-io-bytes", "-mio", type=int, default=0, dest="max_io_bytes",
+                        help="metadata and log byte rate limit, like fileCheck.py --max-io-bytes")
+    parser.add_argument("--cycles", "-n", type=int, default=3, dest="cycles",
+                        help="number of cycles to run")
+    parser.add_argument("--seed", "-s", type=int, default=1, dest="seed",
+                        help="random seed of the synthetic tree")
+    parser.add_argument("--work-dir", "-wd", type=str, dest="work_dir",
+                        help="directory to build the tree in (in a new subdirectory of it), default the temp directory")
+    parser.add_argument("--keep", action="store_true", dest="keep",
+                        help="keep the synthetic tree after the run")
+    parser.add_argument("--output", "-o", type=str, dest="output",
+                        help="JSON file to save the results to")
+    parser.add_argument("--compare", "-cmp", type=str, dest="compare",
+                        help="JSON results of an earlier run to compare against")
+
+    return parser.parse_args()
+
+def read_proc_counters():
+    # Read/write system calls of this process, Linux only
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                counters[name] = int(value)
+    except OSError:
+        pass
+    return counters
+
+def reset_peak_rss():
+    # Linux resets the VmHWM high-water mark when "5" is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_kb(reset_worked):
+    if reset_worked:
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+    # Peak of the whole process so far (kilobytes on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class SyscallCounter:
+    '''
+    Counts the stat and directory listing calls fileCheck makes through the os module.
+    DirEntry.stat() is not counted, it is one lstat per entry the first time it is called.
+    '''
+
+    def __init__(self):
+        self.counts = {"scandir": 0, "stat": 0}
+        self.originals = {}
+
+    def wrap(self, name, counter_name):
+        original = getattr(os, name)
+        self.originals[name] = original
+
+        def counted(*args, **kwargs):
+            self.counts[counter_name] += 1
+            return original(*args, **kwargs)
+        setattr(os, name, counted)
+
+    def __enter__(self):
+        self.wrap('scandir', 'scandir')
+        self.wrap('stat', 'stat')
+        self.wrap('lstat', 'stat')
+        return self
+
+    def __exit__(self, *exc_info):
+        for name, original in self.originals.items():
+            setattr(os, name, original)
+
+def measure(phase, function, *args):
+    # Runs one phase and returns (its result, its metrics)
+    reset_worked = reset_peak_rss()
+    io_before = read_proc_counters()
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    with SyscallCounter() as syscalls:
+        result = function(*args)
+    wall_s = time.perf_counter() - start
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    io_after = read_proc_counters()
+
+    metrics = {
+        "phase": phase,
+        "wall_s": round(wall_s, 6),
+        "cpu_s": round((usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime), 6),
+        "scandir_calls": syscalls.counts["scandir"],
+        "stat_calls": syscalls.counts["stat"],
+        "read_syscalls": io_after.get("syscr", 0) - io_before.get("syscr", 0),
+        "write_syscalls": io_after.get("syscw", 0) - io_before.get("syscw", 0),
+        "blocks_in": usage_after.ru_inblock - usage_before.ru_inblock,
+        "blocks_out": usage_after.ru_oublock - usage_before.ru_oublock,
+        "peak_rss_kb": peak_rss_kb(reset_worked),
+        "peak_rss_scope": "phase" if reset_worked else "process",
+    }
+    return result, metrics
+
+def build_directories(root, depth, fanout):
+    directories = [root]
+    level = [root]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(fanout):
+                directory = os.path.join(parent, f"d{i}")
+                os.mkdir(directory)
+                next_level.append(directory)
+        directories.extend(next_level)
+        level = next_level
+    return directories
+
+def create_file(file_path, rng, aged_ratio):
+    with open(file_path, 'w') as f:
+        f.write("x\n")
+    # Aged files get an mtime past the max file age, the rest are fresh
+    age = MAX_FILE_AGE * 2 if rng.random() < aged_ratio else 0
+    mtime = time.time() - age
+    os.utime(file_path, (mtime, mtime))
+
+def build_tree(work_dir, args, rng):
+    '''
+    Creates the watched tree, exclude file, expired folder, metadata file and log file
+    under work_dir, returns a dict of their paths and the list of files.
+    '''
+    paths = {
+        "root": os.path.join(work_dir, "watched"),
+        "exp_folder": os.path.join(work_dir, "expired"),
+        "exclude_file": os.path.join(work_dir, "exclude.txt"),
+        "meta_file": os.path.join(work_dir, "metadata.txt"),
+        "log_file": os.path.join(work_dir, "fileCheck.log"),
+    }
+    os.makedirs(paths["root"])
+    os.makedirs(paths["exp_folder"])
+    directories = build_directories(paths["root"], args.depth, args.fanout)
+
+    files = []
+    for i in range(args.files):
+        file_path = os.path.join(directories[i % len(directories)], f"file{i}.txt")
+        create_file(file_path, rng, args.aged_ratio)
+        files.append(file_path)
+
+    # Exclude a share of the directories below the root
+    excluded = rng.sample(directories[1:], int(len(directories[1:]) * args.exclude_ratio))
+    with open(paths["exclude_file"], 'w') as f:
+        for directory in excluded:
+            f.write(f"{directory}\n")
+
+    # Metadata of files that are long gone, delete_files cleans them up in the first cycle
+    meta_store = open_metadata_store(paths["meta_file"], args.meta_backend)
+    creation_time = datetime.datetime(2024, 1, 1)
+    for i in range(args.metadata_entries):
+        meta_store.add(os.path.join(paths["root"], f"gone{i}.txt"), creation_time)
+    meta_store.commit()
+    meta_store.close()
+
+    with open(paths["log_file"], 'w') as f:
+        for i in range(args.log_lines):
+            f.write(f"{creation_time} - File '{os.path.join(paths['root'], f'old{i}.txt')}' added at {creation_time}\n")
+    return paths, files
+
+def apply_churn(files, args, rng):
+    # Remove a share of the files and create as many new ones next to them
+    count = int(len(files) * args.churn)
+    removed = set(rng.sample(files, min(count, len(files))))
+    for file_path in removed:
+        os.remove(file_path)
+    files[:] = [file_path for file_path in files if file_path not in removed]
+    for i in range(count):
+        directory = os.path.dirname(rng.choice(files)) if files else None
+        if directory is None:
+            break
+        file_path = os.path.join(directory, f"new{rng.getrandbits(48):x}.txt")
+        create_file(file_path, rng, args.aged_ratio)
+        files.append(file_path)
+
+def run_benchmark(args, work_dir):
+    rng = random.Random(args.seed)
+    (paths, files), build_metrics = measure("build", build_tree, work_dir, args, rng)
+    index_file = os.path.join(work_dir, "scan-index.pickle")
+
+    # Expiry log lines go to the synthetic log file only
+    root_logger = logging.getLogger()
+    saved_handlers, saved_level = root_logger.handlers[:], root_logger.level
+    log_handler = logging.FileHandler(paths["log_file"])
+    log_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+    root_logger.handlers = [log_handler]
+    root_logger.setLevel(logging.INFO)
+
+    # The same arguments the daemon passes to run_cycle
+    cycle_args = argparse.Namespace(dirToW=paths["root"], lf=paths["log_file"], exp_folder=paths["exp_folder"],
+                                    maxfileage=MAX_FILE_AGE, scan_workers=args.scan_workers, mode="poll", intl=60,
+                                    reconcile_intl=3600, summary_intl=0,
+                                    index_file=index_file if args.incremental else None)
+    meta_store = open_metadata_store(paths["meta_file"], args.meta_backend)
+    file_timestamps = TrackedFiles()
+    scan_index = new_scan_index() if args.incremental else None
+    metrics_local.throttle = Throttle(args.max_stats, args.max_io_bytes)
+    cycles = []
+    try:
+        for cycle in range(args.cycles):
+            if cycle:
+                apply_churn(files, args, rng)
+            phases = []
+            exclude_list, metrics = measure("read_exclude_list", read_exclude_list, paths["exclude_file"])
+            phases.append(metrics)
+            phases.append(measure("run_cycle", functools.partial(run_cycle, cycle_args, meta_store, file_timestamps,
+                                                                 scan_index, exclude_list))[1])
+            # Counters and step times run_cycle recorded itself, the walk time excludes the aging check it feeds
+            cycle_metrics = dict(current_metrics().last)
+
+            cycles.append({
+                "cycle": cycle,
+                "files_scanned": cycle_metrics["files_scanned"],
+                "metadata_bytes": os.path.getsize(paths["meta_file"]),
+                "log_bytes": os.path.getsize(paths["log_file"]),
+                "wall_s": round(sum(phase["wall_s"] for phase in phases), 6),
+                "walk_s": cycle_metrics["walk_duration_seconds"],
+                "steps": {step: cycle_metrics[f"{step}_duration_seconds"] for step in CYCLE_STEPS},
+                "phases": phases,
+                "metrics": cycle_metrics,
+            })
+    finally:
+        del metrics_local.throttle
+        meta_store.close()
+        log_handler.close()
+        root_logger.handlers, root_logger.level = saved_handlers, saved_level
+
+    return {
+        "format": BENCH_FORMAT_VERSION,
+        "fileCheck_version": source_version(),
+        "started": datetime.datetime.now().strftime(METADATA_TIME_FORMAT),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "build": build_metrics,
+        "parameters": {name: value for name, value in vars(args).items()
+                       if name not in ("work_dir", "keep", "output", "compare")},
+        "cycles": cycles,
+        "summary": summarize(cycles),
+    }
+
+def source_version():
+    # Git commit of fileCheck.py when it is run from a checkout
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(fileCheck.__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def summarize(cycles):
+    # Median wall time and worst peak memory of every phase and run_cycle step over all cycles
+    summary = {}
+    for cycle in cycles:
+        cycle_peak = max((phase["peak_rss_kb"] for phase in cycle["phases"]), default=0)
+        derived = [{"phase": step, "wall_s": seconds, "peak_rss_kb": cycle_peak}
+                   for step, seconds in cycle["steps"].items()]
+        derived.append({"phase": "cycle", "wall_s": cycle["wall_s"], "peak_rss_kb": cycle_peak})
+        for phase in cycle["phases"] + derived:
+            entry = summary.setdefault(phase["phase"], {"wall_s": [], "peak_rss_kb": 0})
+            entry["wall_s"].append(phase["wall_s"])
+            entry["peak_rss_kb"] = max(entry["peak_rss_kb"], phase.get("peak_rss_kb", 0))
+    for entry in summary.values():
+        wall_times = sorted(entry["wall_s"])
+        entry["wall_s"] = wall_times[len(wall_times) // 2]
+    return summary
+
+def compare(results, baseline):
+    # One line per phase, the ratio is this run's median wall time over the baseline's
+    lines = []
+    for phase, entry in results["summary"].items():
+        before = baseline.get("summary", {}).get(phase)
+        if before and before["wall_s"]:
+            ratio = entry["wall_s"] / before["wall_s"]
+            lines.append(f"{phase:<18} {before['wall_s']:>10.4f}s -> {entry['wall_s']:>10.4f}s  x{ratio:.2f}")
+        else:
+            lines.append(f"{phase:<18} {'':>11} -> {entry['wall_s']:>10.4f}s  (new)")
+    return lines
+
+def main():
+    args = parse_arguments()
+    # Always a new directory, so only what the benchmark created is ever removed
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="fileCheck-bench-", dir=args.work_dir)
+    try:
+        results = run_benchmark(args, work_dir)
+    finally:
+        if args.keep:
+            print(f"Synthetic tree kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    for phase, entry in results["summary"].items():
+        print(f"{phase:<18} {entry['wall_s']:>10.4f}s  peak {entry['peak_rss_kb']} kB")
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+        print(f"Results saved to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            print("\n".join(compare(results, json.load(f))))
+
+if __name__ == "__main__":
+    sys.exit(main())
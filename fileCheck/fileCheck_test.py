@@ -4,18 +4,30 @@ This test is created using Unittest testing Framework
 '''
 
 import unittest
+import argparse
 import os
+import shutil
+import datetime
+from pathlib import Path
 import logging
 import tempfile
+import threading
 from unittest.mock import patch
-from fileCheck import configure_logging, read_exclude_list, check_existing_files, log_created_file, delete_files
+import fileCheck
+from fileCheck import configure_logging, read_exclude_list, check_files, log_created_file, delete_files
+from fileCheck import glob_to_regex, build_parser, root_arguments, Metrics, render_metrics, TokenBucket, Throttle, metrics_local, budgeted, scan_directory
+from fileCheck import run_cycle, metrics, schedule_expiries, expire_due, next_wakeup, new_scan_index, scan_incremental, scan_files, is_excluded, TrackedFiles, InotifyWatcher, open_metadata_store, compact_log, log_segments
 
 class TestScript(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
         # Create a single temporary directory for all tests
-        cls.test_dir = tempfile.mkdtemp(dir='/home/semir-testing/floor/test-env/')
+        cls.test_dir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.test_dir)
 
     def setUp(self):
         # Create mock directory within the single temporary directory
@@ -50,54 +62,528 @@ class TestScript(unittest.TestCase):
 
         # Create the log file
         self.log_file = os.path.join(self.test_dir, "test.log")
-        logging.basicConfig(filename=self.log_file, level=logging.DEBUG,
-                            format='%(asctime)s - %(message)s', filemode='a+')
 
-        # Configure logging for the tests
-        configure_logging(self.log_file)
+    def tearDown(self):
+        # Every test starts without metadata or expired markers
+        for file_path in [self.metadata_file, self.metadata_file + ".migrated"]:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        for marker_name in os.listdir(self.expired_folder):
+            os.remove(os.path.join(self.expired_folder, marker_name))
 
     def test_configure_logging_with_correct_settings(self):
-        # Verify that logging is correctly configured
+        # Configure logging on a clean root logger, the test runner may have its own handlers
         logger = logging.getLogger()
+        saved_handlers, saved_level = logger.handlers[:], logger.level
+        logger.handlers = []
+        try:
+            configure_logging(self.log_file)
 
-        self.assertEqual(len(logger.handlers), 1)  # Check for one handler: file handler
-        file_handler = logger.handlers[0]
-        self.assertEqual(file_handler.baseFilename, self.log_file)
-        self.assertEqual(file_handler.level, logging.DEBUG)
-        self.assertEqual(file_handler.formatter._fmt, '%(asctime)s - %(message)s')
+            # Check for two handlers: the log file and the console
+            self.assertEqual(len(logger.handlers), 2)
+            file_handler, console_handler = logger.handlers
+            self.assertEqual(file_handler.baseFilename, self.log_file)
+            self.assertEqual(logger.level, logging.DEBUG)
+            self.assertEqual(file_handler.formatter._fmt, '%(asctime)s - %(message)s')
+            self.assertEqual(console_handler.level, logging.INFO)
+        finally:
+            for handler in logger.handlers:
+                handler.close()
+            logger.handlers, logger.level = saved_handlers, saved_level
 
     def test_read_exclude_list(self):
         exclude_list = read_exclude_list(self.exclude_file)
         self.assertIn(str(os.path.join(self.mock_dir, "file1")), {str(path) for path in exclude_list})
 
     @patch('fileCheck.logging.info')
-    def test_check_existing_files(self, mock_logging):
-        # Create a test file in the directory
-        test_file_path = os.path.join(self.mock_dir, "test_file.txt")
-        with open(test_file_path, "w") as test_file:
-            test_file.write("test\n")
+    def test_check_files(self, mock_logging):
+        # Every file is past a max age of -1 seconds, file1 is excluded
+        exclude_list = read_exclude_list(self.exclude_file)
+        meta_store = open_metadata_store(self.metadata_file)
+        check_files(scan_files(self.mock_dir), self.log_file, exclude_list, self.expired_folder,
+                    meta_store, TrackedFiles(), -1)
 
-        # Call check_existing_files and assert that it logs the file
-        check_existing_files(set(), self.mock_dir, "test.log", set(), self.expired_folder, self.metadata_file)
-        mock_logging.assert_called_once()
+        expired = {os.path.basename(file_path) for file_path in meta_store.entries()}
+        self.assertEqual(expired, {"file2", "file3.txt"})
+        self.assertEqual(mock_logging.call_count, 4)  # Aged and added lines for each file
+
+        # Files already expired are not logged again
+        check_files(scan_files(self.mock_dir), self.log_file, exclude_list, self.expired_folder,
+                    meta_store, TrackedFiles(), -1)
+        self.assertEqual(mock_logging.call_count, 4)
 
     @patch('pathlib.Path.write_text')
     def test_log_created_file(self, mock_write_text):
-        log_created_file("test_file.txt", "test.log", self.expired_folder, self.metadata_file)
+        meta_store = open_metadata_store(self.metadata_file)
+        log_created_file("test_file.txt", "test.log", self.expired_folder, meta_store, datetime.datetime(2024, 1, 1))
         mock_write_text.assert_called_once()
+        self.assertEqual(meta_store.marker("test_file.txt"), "2024-01-01_00:00:00_test_file.txt")
 
     @patch('os.remove')
     @patch('fileCheck.logging.info')
     def test_delete_files(self, mock_logging, mock_remove):
-        # Create a file in the expired folder
+        # Record a file that is no longer in the directory, with its marker in the expired folder
+        meta_store = open_metadata_store(self.metadata_file)
+        gone_path = os.path.join(os.path.realpath(self.mock_dir), "expired_file.txt")
+        meta_store.add(gone_path, datetime.datetime(2024, 1, 1), "expired_file.txt")
+        meta_store.commit()
         expired_file_path = os.path.join(self.expired_folder, "expired_file.txt")
         with open(expired_file_path, "w") as expired_file:
-            expired_file.write("expired")
+            expired_file.write(f"{gone_path}\n")
 
-        # Call delete_files and assert that it deletes the file
-        delete_files(self.mock_dir, self.expired_folder, self.metadata_file)
-        mock_logging.assert_called_once()
+        # Call delete_files and assert that it deletes the marker
+        delete_files({path for path, mtime in scan_files(self.mock_dir)}, self.expired_folder, meta_store, self.log_file)
         mock_remove.assert_called_once_with(expired_file_path)
+        mock_logging.assert_any_call(f"Deleted expired file: {expired_file_path}")
+
+    def test_excluded_directory_covers_new_files(self):
+        with open(self.exclude_file, "a") as f:
+            f.write(self.another_dir + "\n")
+        exclude_list = read_exclude_list(self.exclude_file)
+
+        new_file_path = Path(self.another_dir).resolve() / "created_later.txt"
+        self.assertTrue(is_excluded(new_file_path, exclude_list))
+        self.assertFalse(is_excluded(Path(self.mock_dir).resolve() / "file2", exclude_list))
+
+    def test_glob_character_classes(self):
+        # Only a leading "!" negates, other characters in the class are literal
+        self.assertTrue(glob_to_regex("[a!b].txt").match("/data/!.txt"))
+        self.assertFalse(glob_to_regex("[a!b].txt").match("/data/^.txt"))
+        self.assertFalse(glob_to_regex("[!ab].txt").match("/data/a.txt"))
+        self.assertTrue(glob_to_regex("[!ab].txt").match("/data/c.txt"))
+        self.assertTrue(glob_to_regex("[]a].txt").match("/data/].txt"))
+        self.assertTrue(glob_to_regex("[\\]x").match("/data/\\x"))
+        self.assertTrue(glob_to_regex("file[0-9]").match("/data/file5"))
+        self.assertTrue(glob_to_regex("a[b").match("/data/a[b"))
+
+    def test_scan_files_prunes_excluded_subtrees(self):
+        with open(self.exclude_file, "w") as f:
+            f.write(self.another_dir + "\n")
+            f.write("*2\n")
+        exclude_list = read_exclude_list(self.exclude_file)
+        self.assertIs(read_exclude_list(self.exclude_file, exclude_list), exclude_list)
+
+        scanned = {os.path.basename(path) for path, mtime in scan_files(self.mock_dir, exclusions=exclude_list)}
+        self.assertIn("file1", scanned)
+        self.assertNotIn("file2", scanned)
+        self.assertNotIn("file3.txt", scanned)
+
+    def test_tracked_files_evicts_vanished_files(self):
+        file_timestamps = TrackedFiles()
+        kept_path = os.path.join(self.mock_dir, "file2")
+        gone_path = os.path.join(self.another_dir, "gone.txt")
+        file_timestamps[kept_path] = datetime.datetime(2024, 1, 1)
+        file_timestamps[gone_path] = datetime.datetime(2024, 1, 1)
+        self.assertEqual(len(file_timestamps), 2)
+
+        file_timestamps.start_scan()
+        self.assertEqual(file_timestamps.see(kept_path), datetime.datetime(2024, 1, 1))
+        file_timestamps.evict()
+        self.assertEqual(len(file_timestamps), 1)
+        self.assertNotIn(gone_path, file_timestamps)
+        self.assertEqual(file_timestamps.get(kept_path), datetime.datetime(2024, 1, 1))
+        self.assertEqual(list(file_timestamps.dirs), [self.mock_dir])
+
+    def test_run_cycle_evicts_files_the_walk_no_longer_finds(self):
+        args = argparse.Namespace(dirToW=self.mock_dir, scan_workers=1, lf=self.log_file, exp_folder=self.expired_folder,
+                                  maxfileage=3600, index_file=None, mode="poll", intl=60, summary_intl=0)
+        meta_store = open_metadata_store(self.metadata_file)
+        file_timestamps = TrackedFiles()
+        gone_path = os.path.join(os.path.realpath(self.another_dir), "gone.txt")
+        Path(gone_path).write_text("gone\n")
+        run_cycle(args, meta_store, file_timestamps, None, None)
+        self.assertIn(gone_path, file_timestamps)
+
+        os.remove(gone_path)
+        run_cycle(args, meta_store, file_timestamps, None, None)
+        self.assertNotIn(gone_path, file_timestamps)
+        self.assertEqual(len(file_timestamps), 3)
+
+    def test_scan_incremental(self):
+        scan_index = new_scan_index()
+        scanned = {path for path, mtime in scan_incremental(self.mock_dir, scan_index)}
+        self.assertIn(os.path.realpath(os.path.join(self.another_dir, "file3.txt")), scanned)
+
+        # A new file shows up on the next pass
+        new_file_path = os.path.join(self.another_dir, "file4.txt")
+        with open(new_file_path, "w") as new_file:
+            new_file.write("content4\n")
+        scanned = {path for path, mtime in scan_incremental(self.mock_dir, scan_index)}
+        self.assertIn(os.path.realpath(new_file_path), scanned)
+
+        # A removed file is dropped from the index
+        os.remove(new_file_path)
+        scanned = {path for path, mtime in scan_incremental(self.mock_dir, scan_index)}
+        self.assertNotIn(os.path.realpath(new_file_path), scanned)
+
+    def test_scan_files_with_workers(self):
+        serial = sorted(path for path, mtime in scan_files(self.mock_dir))
+        parallel = sorted(path for path, mtime in scan_files(self.mock_dir, workers=4))
+        self.assertEqual(serial, parallel)
+        self.assertIn(os.path.realpath(os.path.join(self.another_dir, "file3.txt")), parallel)
+
+    def test_inotify_watcher_events(self):
+        watcher = InotifyWatcher(self.mock_dir)
+        try:
+            watcher.add_tree(watcher.root)
+            new_file_path = os.path.join(self.another_dir, "file5.txt")
+            with open(new_file_path, "w") as new_file:
+                new_file.write("content5\n")
+            os.remove(new_file_path)
+
+            events = list(watcher.read_events(1))
+            self.assertIn(("created", os.path.join(os.path.realpath(self.another_dir), "file5.txt")), events)
+            self.assertIn(("deleted", os.path.join(os.path.realpath(self.another_dir), "file5.txt")), events)
+        finally:
+            watcher.close()
+
+    def test_inotify_watcher_skips_excluded_directories(self):
+        exclude_file = os.path.join(self.test_dir, "exclude_dir.txt")
+        with open(exclude_file, "w") as f:
+            f.write(os.path.realpath(self.another_dir) + "\n")
+        watcher = InotifyWatcher(self.mock_dir, read_exclude_list(exclude_file))
+        try:
+            watcher.add_tree(watcher.root)
+            self.assertNotIn(os.path.realpath(self.another_dir), watcher.watches.values())
+            with open(os.path.join(self.another_dir, "file5.txt"), "w") as new_file:
+                new_file.write("content5\n")
+            os.remove(os.path.join(self.another_dir, "file5.txt"))
+            self.assertEqual(list(watcher.read_events(0.1)), [])
+        finally:
+            watcher.close()
+            os.remove(exclude_file)
+
+    def test_inotify_watcher_forgets_a_directory_moved_out(self):
+        outside_dir = os.path.join(self.test_dir, "outside")
+        watcher = InotifyWatcher(self.mock_dir)
+        try:
+            watcher.add_tree(watcher.root)
+            os.rename(self.another_dir, outside_dir)
+            events = list(watcher.read_events(1))
+            self.assertIn(("deleted_dir", os.path.realpath(self.another_dir)), events)
+            self.assertEqual(set(watcher.watches.values()), {os.path.realpath(self.mock_dir)})
+
+            with open(os.path.join(outside_dir, "x.txt"), "w") as new_file:
+                new_file.write("x\n")
+            self.assertEqual(list(watcher.read_events(0.1)), [])
+        finally:
+            watcher.close()
+            shutil.rmtree(outside_dir, ignore_errors=True)
+
+    def test_inotify_watches_follow_the_cycle_listing(self):
+        args = argparse.Namespace(dirToW=self.mock_dir, scan_workers=1, lf=self.log_file, exp_folder=self.expired_folder,
+                                  maxfileage=3600, index_file=None, mode="inotify", reconcile_intl=60, summary_intl=0)
+        tree = {os.path.realpath(self.mock_dir), os.path.realpath(self.another_dir)}
+        new_file_path = os.path.join(os.path.realpath(self.mock_dir), "created_during_scan.txt")
+        watcher = InotifyWatcher(self.mock_dir)
+
+        def watch_then_create(directory):
+            # A file created once its directory is watched, before the rest of the scan, sends an event
+            watcher.watch_directory(directory)
+            if directory == os.path.realpath(self.another_dir):
+                Path(new_file_path).write_text("new\n")
+        try:
+            watcher.start_sync()
+            run_cycle(args, open_metadata_store(self.metadata_file), TrackedFiles(), None, None, watch_then_create)
+            watcher.finish_sync()
+            self.assertEqual(set(watcher.watches.values()), tree)
+            self.assertIn(("created", new_file_path), list(watcher.read_events(1)))
+
+            # A directory the next scan no longer reaches loses its watch
+            watcher.start_sync()
+            watcher.watch_directory(os.path.realpath(self.mock_dir))
+            watcher.finish_sync()
+            self.assertEqual(set(watcher.watches.values()), {os.path.realpath(self.mock_dir)})
+        finally:
+            watcher.close()
+            os.remove(new_file_path)
+
+    @patch('fileCheck.logging.info')
+    def test_sqlite_metadata_store_starts_on_an_empty_file(self, mock_logging):
+        Path(self.metadata_file).touch()
+        meta_store = open_metadata_store(self.metadata_file, "sqlite")
+        try:
+            self.assertFalse(os.path.exists(self.metadata_file + ".migrated"))
+            mock_logging.assert_not_called()
+            self.assertEqual(meta_store.entries(), {})
+        finally:
+            meta_store.close()
+
+    def test_sqlite_metadata_store_migrates_text_file(self):
+        file_path = os.path.join(self.mock_dir, "file2")
+        with open(self.metadata_file, "w") as f:
+            f.write(f"2024-01-01_00:00:00, {file_path}\n")
+
+        meta_store = open_metadata_store(self.metadata_file, "sqlite")
+        try:
+            self.assertTrue(os.path.exists(self.metadata_file + ".migrated"))
+            self.assertEqual(meta_store.entries(), {file_path: datetime.datetime(2024, 1, 1)})
+
+            other_path = os.path.join(self.another_dir, "file3.txt")
+            meta_store.add(other_path, datetime.datetime(2024, 1, 2))
+            meta_store.commit()
+            meta_store.remove([file_path])
+            # A second connection reads back what was written
+            reopened = open_metadata_store(self.metadata_file, "sqlite")
+            self.assertEqual(reopened.entries(), {other_path: datetime.datetime(2024, 1, 2)})
+            reopened.close()
+        finally:
+            meta_store.close()
+            os.remove(self.metadata_file)
+            os.remove(self.metadata_file + ".migrated")
+
+    def test_delete_files_removes_markers_and_metadata(self):
+        meta_store = open_metadata_store(self.metadata_file)
+        gone_path = os.path.join(os.path.realpath(self.mock_dir), "gone.txt")
+        kept_path = os.path.join(os.path.realpath(self.mock_dir), "file2")
+        log_created_file(gone_path, self.log_file, self.expired_folder, meta_store, datetime.datetime(2024, 1, 1))
+        log_created_file(kept_path, self.log_file, self.expired_folder, meta_store, datetime.datetime(2024, 1, 1))
+        meta_store.commit()
+        gone_marker = os.path.join(self.expired_folder, meta_store.marker(gone_path))
+        kept_marker = os.path.join(self.expired_folder, meta_store.marker(kept_path))
+
+        delete_files({path for path, mtime in scan_files(self.mock_dir)}, self.expired_folder, meta_store, self.log_file)
+        self.assertFalse(os.path.exists(gone_marker))
+        self.assertTrue(os.path.exists(kept_marker))
+        self.assertNotIn(gone_path, {str(path) for path in meta_store.entries()})
+        os.remove(kept_marker)
+        os.remove(self.metadata_file)
+
+    def test_compact_log_drops_tombstoned_entries(self):
+        gone_path = os.path.join(self.mock_dir, "gone.txt")
+        kept_path = os.path.join(self.mock_dir, "file2")
+        backup_file = f"{self.log_file}.1"
+        with open(backup_file, "w") as lf:
+            lf.write(f"File '{gone_path}' added at 2024-01-01 00:00:00\n")
+            lf.write(f"File '{kept_path}' added at 2024-01-01 00:00:00\n")
+        live_lines = [f"Removed file '{gone_path}'\n", f"File '{gone_path}' added at 2024-01-02 00:00:00\n"]
+        with open(self.log_file, "w") as lf:
+            lf.writelines(live_lines)
+
+        try:
+            self.assertEqual(compact_log(self.log_file), 1)
+            with open(backup_file) as lf:
+                self.assertEqual(lf.readlines(), [f"File '{kept_path}' added at 2024-01-01 00:00:00\n"])
+            # The daemon may be appending to the live log, it is left alone
+            with open(self.log_file) as lf:
+                self.assertEqual(lf.readlines(), live_lines)
+        finally:
+            os.remove(backup_file)
+
+    def test_compact_log_starts_over_when_the_log_rotates(self):
+        log_dir = tempfile.mkdtemp()
+        log_file = os.path.join(log_dir, "fc.log")
+        gone_path = os.path.join(self.mock_dir, "gone.txt")
+        kept_line = f"File '{os.path.join(self.mock_dir, 'file2')}' added at 2024-01-02 00:00:00\n"
+        Path(f"{log_file}.1").write_text(f"File '{gone_path}' added at 2024-01-01 00:00:00\n")
+        Path(log_file).write_text(f"Removed file '{gone_path}'\n" + kept_line)
+        real_identity = fileCheck.segment_identity
+        identity_calls = []
+
+        def rotate_after_first_pass(stats):
+            # The handler rotates once both segments have been read
+            identity_calls.append(stats)
+            if len(identity_calls) == 2:
+                os.rename(f"{log_file}.1", f"{log_file}.2")
+                os.rename(log_file, f"{log_file}.1")
+                Path(log_file).write_text("")
+            return real_identity(stats)
+        try:
+            with patch('fileCheck.segment_identity', side_effect=rotate_after_first_pass):
+                self.assertEqual(compact_log(log_file), 2)
+            self.assertEqual(Path(f"{log_file}.2").read_text(), "")
+            # The rotated live log keeps its other lines
+            self.assertEqual(Path(f"{log_file}.1").read_text(), kept_line)
+        finally:
+            shutil.rmtree(log_dir)
+
+    def test_log_segments_only_match_rotation_suffixes(self):
+        log_dir = tempfile.mkdtemp()
+        try:
+            log_file = os.path.join(log_dir, "fc.log")
+            for name in ["fc.log", "fc.log.1", "fc.log.2", "fc.log.idx", "fc.log.tmp", "fc.log.2024-01-02", "fc.log.2024-01-01"]:
+                Path(log_dir, name).write_bytes(b"\x80\x04")
+            self.assertEqual([path.name for path in log_segments(log_file)],
+                             ["fc.log.2", "fc.log.1", "fc.log.2024-01-01", "fc.log.2024-01-02", "fc.log"])
+        finally:
+            shutil.rmtree(log_dir)
+
+    @patch('fileCheck.logging.info')
+    def test_run_cycle_records_metrics(self, mock_logging):
+        args = argparse.Namespace(dirToW=self.mock_dir, scan_workers=1, lf=self.log_file, exp_folder=self.expired_folder,
+                                  maxfileage=-1, index_file=None, mode="poll", intl=60, summary_intl=0)
+        meta_store = open_metadata_store(self.metadata_file)
+        run_cycle(args, meta_store, TrackedFiles(), None, read_exclude_list(self.exclude_file))
+
+        self.assertEqual(metrics.last["files_scanned"], 2)  # file1 is excluded
+        self.assertEqual(metrics.last["files_expired"], 2)
+        self.assertEqual(metrics.last["interval_seconds"], 60)
+        self.assertGreater(metrics.last["metadata_bytes_written"], 0)
+        exposition = metrics.render()
+        self.assertIn("filecheck_last_cycle_files_scanned 2\n", exposition)
+        self.assertIn("# TYPE filecheck_files_expired_total counter", exposition)
+
+    @patch('fileCheck.time.sleep')
+    def test_token_bucket_sleeps_off_overdraw(self, mock_sleep):
+        bucket = TokenBucket(1000)
+        self.assertEqual(bucket.take(1000), 0)  # One second's worth is allowed at once
+        self.assertAlmostEqual(bucket.take(200), 0.2, delta=0.02)
+        mock_sleep.assert_called_once()
+
+    def test_large_directory_is_charged_in_chunks(self):
+        flat_dir = tempfile.mkdtemp()
+        try:
+            for i in range(200):
+                Path(flat_dir, f"f{i}").touch()
+            metrics_local.throttle = Throttle()
+            with patch.object(metrics_local.throttle, 'stats') as mock_stats:
+                files, subdirs = scan_directory(flat_dir)
+        finally:
+            del metrics_local.throttle
+            shutil.rmtree(flat_dir)
+        charges = [call.args[0] for call in mock_stats.call_args_list]
+        self.assertEqual(sum(charges), 200)
+        self.assertLessEqual(max(charges), 64)
+
+    def test_throttle_waits_outside_the_io_budget(self):
+        io_budget = threading.BoundedSemaphore(1)
+        slot_free_while_waiting = []
+
+        def sleep(seconds):
+            # Another root could take the slot now
+            slot_free_while_waiting.append(io_budget.acquire(blocking=False))
+            io_budget.release()
+
+        def list_function(directory):
+            metrics_local.throttle.stats(10)
+            return [], []
+
+        metrics_local.throttle = Throttle(max_stats=1)
+        try:
+            with patch('fileCheck.time.sleep', sleep):
+                budgeted(list_function, io_budget)(self.mock_dir)
+        finally:
+            del metrics_local.throttle
+        self.assertEqual(slot_free_while_waiting, [True])
+        self.assertTrue(io_budget.acquire(blocking=False))  # Slot given back after the listing
+
+    @patch('fileCheck.time.sleep')
+    @patch('fileCheck.logging.info')
+    def test_throttled_run_cycle_reports_limits(self, mock_logging, mock_sleep):
+        args = argparse.Namespace(dirToW=self.mock_dir, scan_workers=1, lf=self.log_file, exp_folder=self.expired_folder,
+                                  maxfileage=-1, index_file=None, mode="poll", intl=60, summary_intl=0)
+        meta_store = open_metadata_store(self.metadata_file)
+        metrics_local.throttle = Throttle(max_stats=1, max_io_bytes=10)
+        try:
+            run_cycle(args, meta_store, TrackedFiles(), None, read_exclude_list(self.exclude_file))
+        finally:
+            del metrics_local.throttle
+
+        self.assertTrue(mock_sleep.called)
+        self.assertGreater(metrics.last["throttle_wait_seconds"], 0)
+        self.assertEqual(metrics.last["stat_limit_per_second"], 1)
+        self.assertEqual(metrics.last["io_bytes_limit_per_second"], 10)
+        self.assertIn("filecheck_stats_per_second ", metrics.render())
+
+    def test_next_wakeup_batches_close_expiries(self):
+        expiry_queue = [(100.0, "a"), (100.5, "b"), (103.0, "c")]
+        self.assertEqual(next_wakeup(list(expiry_queue), 200, batch_window=1), 100.5)
+        self.assertEqual(next_wakeup(list(expiry_queue), 200, batch_window=0), 100.0)
+        self.assertEqual(next_wakeup(list(expiry_queue), 50, batch_window=1), 50)
+        self.assertEqual(next_wakeup([], 200, batch_window=1), 200)
+
+    @patch('fileCheck.logging.info')
+    def test_expire_due_only_expires_files_past_their_deadline(self, mock_logging):
+        args = argparse.Namespace(lf=self.log_file, exp_folder=self.expired_folder, maxfileage=60)
+        meta_store = open_metadata_store(self.metadata_file)
+        file_timestamps = TrackedFiles()
+        now = datetime.datetime.now()
+        old_path = os.path.join(self.mock_dir, "file2")
+        new_path = os.path.join(self.another_dir, "file3.txt")
+        file_timestamps[old_path] = now - datetime.timedelta(seconds=120)
+        file_timestamps[new_path] = now
+        processed_files = meta_store.entries()
+
+        expiry_queue = schedule_expiries(file_timestamps, processed_files, args.maxfileage)
+        self.assertEqual(expire_due(expiry_queue, file_timestamps, processed_files, None, args, meta_store,
+                                    now.timestamp()), 1)
+        self.assertIn(old_path, meta_store.entries())
+        self.assertEqual([os.path.join(directory, name) for expiry, directory, name in expiry_queue], [new_path])
+
+        # Files due after the next rescan are left to it
+        self.assertEqual(schedule_expiries(file_timestamps, processed_files, args.maxfileage, now.timestamp() + 30), [])
+
+    @patch('fileCheck.logging.info')
+    def test_expire_due_skips_files_removed_since_the_scan(self, mock_logging):
+        args = argparse.Namespace(lf=self.log_file, exp_folder=self.expired_folder, maxfileage=60)
+        meta_store = open_metadata_store(self.metadata_file)
+        file_timestamps = TrackedFiles()
+        now = datetime.datetime.now()
+        gone_path = os.path.join(self.mock_dir, "gone.txt")
+        file_timestamps[gone_path] = now - datetime.timedelta(seconds=120)
+        processed_files = meta_store.entries()
+
+        expiry_queue = schedule_expiries(file_timestamps, processed_files, args.maxfileage)
+        self.assertEqual(expire_due(expiry_queue, file_timestamps, processed_files, None, args, meta_store,
+                                    now.timestamp()), 0)
+        self.assertNotIn(gone_path, file_timestamps)
+        self.assertEqual(meta_store.entries(), {})
+        mock_logging.assert_not_called()
+
+    def test_root_arguments_from_config(self):
+        config_file = os.path.join(self.test_dir, "roots.json")
+        with open(config_file, "w") as f:
+            f.write('{"log-file": "%s", "maxfileage": 60, "mode": "poll", "roots": ['
+                    '{"directory": "/data/a", "expired-folder": "/exp/a", "metadata-file": "/meta/a"},'
+                    '{"directory": "/data/b", "expired-folder": "/exp/b", "metadata-file": "/meta/b",'
+                    ' "maxfileage": "3600", "exclude-file": "/etc/b.excl"}]}' % self.log_file)
+        parser = build_parser()
+        global_args, roots = root_arguments(parser.parse_args(["-cfg", config_file, "-i", "30"]), parser)
+
+        self.assertEqual(global_args.lf, self.log_file)
+        self.assertEqual([root_args.dirToW for root_args in roots], ["/data/a", "/data/b"])
+        self.assertEqual([root_args.maxfileage for root_args in roots], [60, 3600])
+        self.assertEqual([root_args.intl for root_args in roots], [30, 30])  # Command line value as default
+        self.assertEqual([root_args.excl_file for root_args in roots], [None, "/etc/b.excl"])
+
+        # Shared state files and process-wide options inside a root are refused
+        for bad_root in ['"metadata-file": "/meta/a"', '"metadata-file": "/meta/b", "metrics-port": 9100']:
+            with open(config_file, "w") as f:
+                f.write('{"log-file": "%s", "maxfileage": 60, "roots": ['
+                        '{"directory": "/data/a", "expired-folder": "/exp/a", "metadata-file": "/meta/a"},'
+                        '{"directory": "/data/b", "expired-folder": "/exp/b", %s}]}' % (self.log_file, bad_root))
+            with self.assertRaises(ValueError):
+                root_arguments(parser.parse_args(["-cfg", config_file]), parser)
+
+    def test_render_metrics_labels_every_root(self):
+        root_a, root_b = Metrics(root="/data/a"), Metrics(root='/data/"b"')
+        root_a.add("files_expired", 3)
+        root_b.add("files_expired", 1)
+        exposition = render_metrics([root_a, root_b])
+        self.assertEqual(exposition.count("# TYPE filecheck_files_expired_total counter"), 1)
+        self.assertIn('filecheck_files_expired_total{root="/data/a"} 3\n', exposition)
+        self.assertIn('filecheck_files_expired_total{root="/data/\\"b\\""} 1\n', exposition)
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_benchmark_reports_every_phase(self):
+        import fileCheck_bench
+        work_dir = tempfile.mkdtemp()
+        try:
+            with patch('sys.argv', ["fileCheck_bench.py", "-f", "200", "-n", "2", "-inc", "-me", "10", "-ll", "10"]):
+                args = fileCheck_bench.parse_arguments()
+            results = fileCheck_bench.run_benchmark(args, work_dir)
+        finally:
+            shutil.rmtree(work_dir)
+
+        self.assertEqual(len(results["cycles"]), 2)
+        phases = [phase["phase"] for phase in results["cycles"][0]["phases"]]
+        self.assertEqual(phases, ["read_exclude_list", "run_cycle"])
+        self.assertGreater(results["cycles"][0]["phases"][1]["scandir_calls"], 0)
+        self.assertGreater(results["cycles"][0]["metrics"]["files_scanned"], 0)
+        self.assertEqual(sorted(results["cycles"][0]["steps"]), ["check", "cleanup", "evict", "index_save", "walk"])
+        for step in ["walk", "check", "index_save", "evict", "cleanup", "cycle"]:
+            self.assertIn(step, results["summary"])
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,41 +1,233 @@
 #A simple SFTP connection from a local machine to an amazon linuz EC2 instance
+#Update: the whole local tree is synced, files whose remote size and mtime already
+#match are skipped and the rest are uploaded over several SFTP channels at once.
+#Interrupted uploads continue from where they stopped on the next run.
 
-import paramiko
 import os
+import re
+import stat
+import time
+import threading
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from sftp_s3 import get_ssh_client, channel_opener, MB
 
-# Define the path to the private key file
-private_key_path = '/home/semir-testing/SFTP/private-key.pem'
+# Suffix of a file while it is being uploaded, renamed to the real name when complete.
+# It carries the local mtime, so a partial upload of an older version is never resumed
+PARTIAL_SUFFIX = '.{mtime}.partial'
+PARTIAL_PATTERN = re.compile(r'^(.*)\.(-?\d+)\.partial$')
+# Size of every write to the remote file
+UPLOAD_BLOCK_SIZE = 1024 * 1024
 
-# Define the SFTP details
-host = '54.146.167.126'
-port = 22
-username = 'ec2-user'
-remote_path = '/home/ec2-user/source_dir'
-local_path = '/home/semir-testing/SFTP-files'
+# Define the SFTP details (defaults of the command line arguments)
+parser = argparse.ArgumentParser(description="Upload a local directory tree to a server over SFTP")
+parser.add_argument("--key", "-k", dest="private_key_path", default='/home/semir-testing/SFTP/private-key.pem', help="Path to the private key file")
+parser.add_argument("--host", "-H", dest="host", default='54.146.167.126', help="SFTP server to upload to")
+parser.add_argument("--port", "-p", dest="port", type=int, default=22, help="SSH port of the server")
+parser.add_argument("--user", "-u", dest="username", default='ec2-user', help="User to log in as")
+parser.add_argument("--remote-path", "-r", dest="remote_path", default='/home/ec2-user/source_dir', help="Directory on the server to upload into")
+parser.add_argument("--local-path", "-l", dest="local_path", default='/home/semir-testing/SFTP-files', help="Local directory to upload")
+parser.add_argument("--workers", "-w", dest="workers", type=int, default=4, help="Number of files uploaded at once, each over its own SFTP channel")
+parser.add_argument("--dry-run", "-n", dest="dry_run", action="store_true", help="Only print which files would be uploaded")
 
-# Load the RSA private key with passphrase
-private_key = paramiko.RSAKey.from_private_key_file(private_key_path)
+def walk_local(local_path):
+    # Yields (relative path, size, mtime) of every regular file under local_path
+    for dirpath, dirnames, filenames in os.walk(local_path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            full_path = os.path.join(dirpath, filename)
+            file_stat = os.stat(full_path)
+            if stat.S_ISREG(file_stat.st_mode):
+                yield os.path.relpath(full_path, local_path), file_stat.st_size, int(file_stat.st_mtime)
 
-# Create an SSH client
-ssh_client = paramiko.SSHClient()
+def list_remote(sftp_client, remote_path):
+    '''
+    Returns {relative path: (size, mtime)} of every file under remote_path.
+    One listdir_attr per directory fetches the attributes of all its entries at once,
+    a missing remote directory is treated as empty.
+    '''
+    remote_files = {}
+    pending = ['']
+    while pending:
+        relative_dir = pending.pop()
+        try:
+            attrs = sftp_client.listdir_attr(os.path.join(remote_path, relative_dir))
+        except IOError:
+            continue
+        for attr in attrs:
+            relative_path = os.path.join(relative_dir, attr.filename)
+            if stat.S_ISDIR(attr.st_mode):
+                pending.append(relative_path)
+            elif stat.S_ISREG(attr.st_mode):
+                remote_files[relative_path] = (attr.st_size, attr.st_mtime)
+    return remote_files
 
-# Automatically add the EC2 instance's host key
-ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+def partial_name(path, mtime):
+    return path + PARTIAL_SUFFIX.format(mtime=mtime)
 
-# Connect to the EC2 instance using the private key
-ssh_client.connect(hostname=host, port=port, username=username, pkey=private_key)
+def plan_uploads(local_files, remote_files):
+    '''
+    Splits the local files into the ones to upload and the ones already on the server.
+    Also returns the partial files left by uploads of other versions of a local file,
+    they can never be resumed and would pile up on the server.
+    '''
+    partials = {}
+    for remote_file in remote_files:
+        match = PARTIAL_PATTERN.match(remote_file)
+        if match:
+            partials.setdefault(match.group(1), []).append((int(match.group(2)), remote_file))
 
-# Create an SFTP session
-sftp = ssh_client.open_sftp()
+    uploads = []
+    skipped = []
+    stale = []
+    for relative_path, size, mtime in local_files:
+        stale.extend(partial_path for partial_mtime, partial_path in partials.get(relative_path, ())
+                     if partial_mtime != mtime)
+        if remote_files.get(relative_path) == (size, mtime):
+            skipped.append((relative_path, size))
+        else:
+            uploads.append((relative_path, size, mtime, remote_files.get(partial_name(relative_path, mtime), (0,))[0]))
+    return uploads, skipped, stale
 
-# Transfer files from local machine to EC2 instance
-for file_name in os.listdir(local_path):
-    local_file_path = os.path.join(local_path, file_name)
-    remote_file_path = os.path.join(remote_path, file_name)
-    sftp.put(local_file_path, remote_file_path)
+def remove_stale_partials(sftp_client, remote_path, stale):
+    for partial_path in stale:
+        try:
+            sftp_client.remove(os.path.join(remote_path, partial_path))
+            print(f"Removed stale partial {partial_path}")
+        except IOError as e:
+            print(f"Failed to remove stale partial {partial_path}: {e}")
 
-# Close the SFTP session and the SSH connection
-sftp.close()
-ssh_client.close()
+def make_remote_dirs(sftp_client, remote_path, uploads):
+    # Creates every remote directory the uploads need, parents first
+    needed = set()
+    for relative_path, size, mtime, partial_size in uploads:
+        relative_dir = os.path.dirname(relative_path)
+        while relative_dir:
+            needed.add(relative_dir)
+            relative_dir = os.path.dirname(relative_dir)
+    for relative_dir in [''] + sorted(needed):
+        try:
+            sftp_client.mkdir(os.path.join(remote_path, relative_dir))
+        except IOError:
+            pass  # Already exists
 
-print("Files transferred successfully.")
+def upload_file(sftp_client, local_file_path, remote_file_path, size, mtime, partial_size=0):
+    '''
+    Uploads into the partial file of remote_file_path, appending to what an interrupted
+    run left there, then renames it and copies the local mtime so the next run skips it.
+    Returns the number of bytes sent.
+    '''
+    partial_path = partial_name(remote_file_path, mtime)
+    offset = partial_size if 0 < partial_size <= size else 0
+    with open(local_file_path, 'rb') as local_file, sftp_client.open(partial_path, 'ab' if offset else 'wb') as remote_file:
+        remote_file.set_pipelined(True)
+        local_file.seek(offset)
+        for block in iter(lambda: local_file.read(UPLOAD_BLOCK_SIZE), b''):
+            remote_file.write(block)
+    try:
+        sftp_client.posix_rename(partial_path, remote_file_path)
+    except IOError:
+        # Servers without the posix-rename extension can't rename over an existing file
+        try:
+            sftp_client.remove(remote_file_path)
+        except IOError:
+            pass
+        sftp_client.rename(partial_path, remote_file_path)
+    sftp_client.utime(remote_file_path, (mtime, mtime))
+    return size - offset
+
+def upload_files(open_channel, local_path, remote_path, uploads, workers=4):
+    # Uploads every planned file, each worker thread over its own SFTP channel
+    local = threading.local()
+    channels = []
+    channels_lock = threading.Lock()
+
+    def worker_channel():
+        if getattr(local, 'sftp_client', None) is None:
+            local.sftp_client = open_channel()
+            with channels_lock:
+                channels.append(local.sftp_client)
+        return local.sftp_client
+
+    def upload_one(upload):
+        relative_path, size, mtime, partial_size = upload
+        try:
+            bytes_sent = upload_file(worker_channel(), os.path.join(local_path, relative_path),
+                                     os.path.join(remote_path, relative_path), size, mtime, partial_size)
+            print(f"Uploaded {relative_path}")
+            return {'file': relative_path, 'status': 'uploaded', 'bytes': bytes_sent}
+        except Exception as e:
+            print(f"Failed to upload {relative_path}: {e}")
+            return {'file': relative_path, 'status': 'failed', 'error': str(e)}
+
+    try:
+        make_remote_dirs(worker_channel(), remote_path, uploads)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            return list(pool.map(upload_one, uploads))
+    finally:
+        for sftp_client in channels:
+            sftp_client.close()
+
+def sync_tree(open_channel, local_path, remote_path, workers=4, dry_run=False):
+    '''
+    Uploads the files under local_path that are missing or changed under remote_path.
+    Returns a summary dict with the uploaded, skipped and failed files and the throughput.
+    '''
+    start = time.monotonic()
+    sftp_client = open_channel()
+    try:
+        remote_files = list_remote(sftp_client, remote_path)
+        uploads, skipped, stale = plan_uploads(walk_local(local_path), remote_files)
+        if not dry_run:
+            remove_stale_partials(sftp_client, remote_path, stale)
+    finally:
+        sftp_client.close()
+
+    if dry_run:
+        for partial_path in stale:
+            print(f"Would remove stale partial {partial_path}")
+        for relative_path, size, mtime, partial_size in uploads:
+            resume = f" (resuming at {partial_size} bytes)" if 0 < partial_size <= size else ""
+            print(f"Would upload {relative_path} ({size} bytes){resume}")
+        results = []
+    else:
+        results = upload_files(open_channel, local_path, remote_path, uploads, workers)
+
+    seconds = time.monotonic() - start
+    bytes_sent = sum(result.get('bytes', 0) for result in results)
+    return {
+        'uploaded': [result['file'] for result in results if result['status'] == 'uploaded'],
+        'failed': [result['file'] for result in results if result['status'] == 'failed'],
+        'planned': [upload[0] for upload in uploads],
+        'stale_partials': stale,
+        'skipped': len(skipped),
+        'bytes': bytes_sent,
+        'seconds': round(seconds, 3),
+        'mb_per_s': round(bytes_sent / MB / seconds, 2) if seconds > 0 else None,
+    }
+
+def main():
+    args = parser.parse_args()
+    import paramiko
+
+    # Load the RSA private key
+    private_key = paramiko.RSAKey.from_private_key_file(args.private_key_path)
+
+    # Connect to the EC2 instance using the private key
+    ssh_client = get_ssh_client(args.host, args.port, args.username, private_key, reuse=False)
+    try:
+        summary = sync_tree(channel_opener(ssh_client), args.local_path, args.remote_path, args.workers, args.dry_run)
+    finally:
+        # Close the SSH connection
+        ssh_client.close()
+
+    if args.dry_run:
+        print(f"{len(summary['planned'])} file(s) to upload, {summary['skipped']} unchanged.")
+    else:
+        print(f"{len(summary['uploaded'])} file(s) transferred, {summary['skipped']} unchanged, "
+              f"{len(summary['failed'])} failed, {summary['bytes']} bytes in {summary['seconds']}s "
+              f"({summary['mb_per_s']} MB/s).")
+    return 1 if summary['failed'] else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,84 @@
+'''
+This is a testing file for SFTP_transfer.py
+The SFTP server is replaced by a local directory
+'''
+
+import unittest
+import os
+import shutil
+import tempfile
+from SFTP_transfer import sync_tree, partial_name
+from sftp_s3_test import LocalSFTP
+
+class TestSyncTree(unittest.TestCase):
+
+    def setUp(self):
+        self.local_path = tempfile.mkdtemp()
+        self.server_root = tempfile.mkdtemp()
+        self.written = []
+        os.makedirs(os.path.join(self.local_path, "a", "b"))
+        for relative_path in ["top.txt", "a/one.txt", "a/b/two.txt"]:
+            with open(os.path.join(self.local_path, relative_path), "w") as f:
+                f.write(relative_path * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.local_path)
+        shutil.rmtree(self.server_root)
+
+    def open_channel(self):
+        return LocalSFTP(self.server_root, self.written)
+
+    def test_uploads_tree_and_skips_unchanged_files(self):
+        summary = sync_tree(self.open_channel, self.local_path, "/dest", workers=3)
+        self.assertEqual(sorted(summary['uploaded']), ["a/b/two.txt", "a/one.txt", "top.txt"])
+        with open(os.path.join(self.server_root, "dest", "a", "b", "two.txt")) as f:
+            self.assertEqual(f.read(), "a/b/two.txt" * 100)
+
+        # Only the changed file is sent again
+        self.written.clear()
+        local_file = os.path.join(self.local_path, "a", "one.txt")
+        with open(local_file, "a") as f:
+            f.write("more")
+        os.utime(local_file, (1700000000, 1700000000))
+        summary = sync_tree(self.open_channel, self.local_path, "/dest")
+        self.assertEqual(summary['uploaded'], ["a/one.txt"])
+        self.assertEqual(summary['skipped'], 2)
+        self.assertEqual(len(self.written), 1)
+
+    def test_dry_run_uploads_nothing(self):
+        summary = sync_tree(self.open_channel, self.local_path, "/dest", dry_run=True)
+        self.assertEqual(len(summary['planned']), 3)
+        self.assertEqual(summary['uploaded'], [])
+        self.assertFalse(os.path.exists(os.path.join(self.server_root, "dest")))
+
+    def test_partial_upload_is_resumed(self):
+        local_file = os.path.join(self.local_path, "top.txt")
+        mtime = int(os.stat(local_file).st_mtime)
+        os.makedirs(os.path.join(self.server_root, "dest"))
+        with open(os.path.join(self.server_root, "dest", partial_name("top.txt", mtime)), "w") as f:
+            f.write("top.txt" * 40)
+
+        summary = sync_tree(self.open_channel, self.local_path, "/dest")
+        with open(os.path.join(self.server_root, "dest", "top.txt")) as f:
+            self.assertEqual(f.read(), "top.txt" * 100)
+        total_bytes = sum(len(relative_path * 100) for relative_path in ["top.txt", "a/one.txt", "a/b/two.txt"])
+        self.assertEqual(summary['bytes'], total_bytes - len("top.txt" * 40))
+
+    def test_partial_of_an_older_version_is_removed(self):
+        local_file = os.path.join(self.local_path, "top.txt")
+        mtime = int(os.stat(local_file).st_mtime)
+        os.makedirs(os.path.join(self.server_root, "dest"))
+        stale_partial = os.path.join(self.server_root, "dest", partial_name("top.txt", mtime - 60))
+        with open(stale_partial, "w") as f:
+            f.write("old")
+
+        summary = sync_tree(self.open_channel, self.local_path, "/dest", dry_run=True)
+        self.assertEqual(summary['stale_partials'], [partial_name("top.txt", mtime - 60)])
+        self.assertTrue(os.path.exists(stale_partial))
+
+        summary = sync_tree(self.open_channel, self.local_path, "/dest")
+        self.assertFalse(os.path.exists(stale_partial))
+        self.assertEqual(sorted(summary['uploaded']), ["a/b/two.txt", "a/one.txt", "top.txt"])
+
+if __name__ == '__main__':
+    unittest.main()
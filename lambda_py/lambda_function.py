@@ -7,14 +7,35 @@ Update:
 The parameters are being passed from a config.json file,
 some of them are passed from the payload feature on cli
 which is equivalent to a test-event parameter on the console
+Update:
+Files are transferred concurrently over several SFTP channels,
+set "max_concurrency" in the payload or the config file (default 4)
+Update:
+The S3 client, config, private key and SSH connection are cached
+between warm invocations, set "reuse_connection" to false in the
+payload or the config file to open a new SSH connection every time
+Update:
+Large files use S3 multipart uploads, "part_size_mb", "s3_concurrency"
+and "read_ahead_mb" in the payload or the config file tune them,
+the response reports the throughput (MB/s) of every file
+Update:
+Transfers are resumable, progress is checkpointed to S3 and the function
+stops "stop_margin_s" seconds before its timeout (statusCode 202), the next
+invocation continues from the last finished part. Set "resumable" to false
+in the payload or the config file to turn this off
+Update:
+The payload can hold a "jobs" list of source_path/dest_path/username,
+they run at the same time (up to "max_jobs") and the response reports
+every job, set "max_job_mb" to split large jobs over follow-on invocations
+Update:
+The pipeline is shared with lambda_function_withSSM.py in sftp_s3.py,
+paramiko and boto3 are only imported when the handler first needs them
 '''
 
 import json
-import paramiko
-import boto3
-import os
 import io
 import sys
+from sftp_s3 import load_s3_text, handle_event
 
 def lambda_handler(event, context):
     # Create a StringIO buffer to capture print statements
@@ -26,71 +47,20 @@ def lambda_handler(event, context):
         bucket_name = "semir-test"
         json_file_key = "config/sftp-config.json"
         
-        # Read source and dest path from event payload
-        source_path = event['source_path']
-        dest_path = event['dest_path']
-        username = event['username']
-        
-        # Initialize S3 client
-        s3_client = boto3.client('s3')
-        
-        # Stream the JSON file from S3
-        json_file_obj = s3_client.get_object(Bucket=bucket_name, Key=json_file_key)
-        config = json.loads(json_file_obj['Body'].read().decode('utf-8'))
-        
-        host = config['host']
-        port = config.get('port', 22)  # Default to port 22 if not specified
-        private_key_path = config['key_path']  # Ensure the key name matches the JSON structure
-        
-        # Print the loaded configuration
-        print(f"Loaded config from S3: {json.dumps(config, indent=2)}")
+        # Read the private key straight from S3 into memory
+        def load_private_key(options, s3_client):
+            return load_s3_text(s3_client, bucket_name, options['key_path'])
         
-        # Download the private key to /tmp directory
-        local_key_path = '/tmp/key.pem'
-        s3_client.download_file(bucket_name, private_key_path, local_key_path)
+        # Config, key, SSH connections and every job of the event
+        response = handle_event(event, context, bucket_name, json_file_key, load_private_key)
         
-        # Load the private key from the local file
-        pem_key = paramiko.RSAKey.from_private_key_file(local_key_path)
-        
-        # Create a new SSH client
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        
-        # Connect to the SFTP server
-        print(f"Connecting to {host}:{port} as {username}...")
-        ssh_client.connect(hostname=host, port=port, username=username, pkey=pem_key)
-        
-        # Create an SFTP client
-        sftp_client = ssh_client.open_sftp()
-        
-        # Transfer files from the source directory directly to S3
-        print(f"Listing files in {source_path}...")
-        for filename in sftp_client.listdir(source_path):
-            remote_file_path = os.path.join(source_path, filename)
-            print(f"Streaming {filename} to S3...")
-            
-            with sftp_client.file(remote_file_path, 'rb') as remote_file:
-                s3_client.upload_fileobj(remote_file, bucket_name, os.path.join(dest_path, filename))
-                
-            sftp_client.remove(remote_file_path)
-            print(f"Transferred and removed {filename} from SFTP server.")
-        
-        # Close the SFTP and SSH connections
-        sftp_client.close()
-        ssh_client.close()
-
         # Get the captured output
         output = buffer.getvalue()
         
         # Reset stdout
         sys.stdout = old_stdout
 
-        # Format the output response
-        response = {
-            'statusCode': 200,
-            'body': 'SFTP file transfer completed successfully',
-            'logs': output
-        }
+        response['logs'] = output
         return json.dumps(response, indent=2)
     except Exception as e:
         # Get the captured output
@@ -0,0 +1,67 @@
+'''
+This script runs a Lambda handler on your own machine with a test event,
+the same way Lambda would call it. It uses your local AWS credentials
+and reaches the SFTP server from your machine, nothing is deployed.
+Follow-on shards are only sent when a deployed function name is given.
+With --profile-startup it reports how long the handler module took to import
+and the init steps of every invocation, run it with -n 2 to compare a cold
+start with a warm one.
+'''
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+import uuid
+
+parser = argparse.ArgumentParser(description="Invoke a Lambda handler locally with a fake context")
+parser.add_argument("--event", "-e", dest="event_file", required=True, help="JSON file with the test event (payload)")
+parser.add_argument("--handler", "-hd", dest="handler", default="lambda_function.lambda_handler", help="module.function of the handler")
+parser.add_argument("--timeout", "-t", dest="timeout", type=int, default=900, help="Timeout of the fake invocation in seconds")
+parser.add_argument("--memory", "-mem", dest="memory", type=int, default=1024, help="Memory size of the fake function in MB")
+parser.add_argument("--function-name", "-fn", dest="function_name", default=None, help="Deployed function to send follow-on shards to")
+parser.add_argument("--profile-startup", "-ps", dest="profile_startup", action="store_true", help="Report import and init timings")
+parser.add_argument("--invocations", "-n", dest="invocations", type=int, default=1, help="Number of invocations in the same process")
+
+class FakeContext:
+    # The attributes of the Lambda context object the handlers use
+    def __init__(self, timeout=900, memory=1024, function_name=None):
+        self.function_name = function_name
+        self.function_version = "$LATEST"
+        self.memory_limit_in_mb = memory
+        self.aws_request_id = str(uuid.uuid4())
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+def load_handler(handler_name):
+    # Returns (handler, seconds the import took, modules it loaded)
+    module_name, function_name = handler_name.rsplit('.', 1)
+    modules_before = len(sys.modules)
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    return getattr(module, function_name), time.perf_counter() - start, len(sys.modules) - modules_before
+
+def main():
+    args = parser.parse_args()
+    with open(args.event_file) as f:
+        event = json.load(f)
+    os.environ.setdefault('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', str(args.memory))
+    if args.profile_startup:
+        os.environ['PROFILE_STARTUP'] = '1'
+
+    handler, import_seconds, modules_loaded = load_handler(args.handler)
+    if args.profile_startup:
+        print(f"Imported {args.handler} in {import_seconds:.4f}s ({modules_loaded} modules)")
+    for invocation in range(max(1, args.invocations)):
+        context = FakeContext(args.timeout, args.memory, args.function_name)
+        start = time.monotonic()
+        response = handler(event, context)
+        print(response if isinstance(response, str) else json.dumps(response, indent=2))
+        print(f"Finished in {time.monotonic() - start:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,808 @@
+'''
+Transfer engine shared by the Lambda handlers, it streams files from an
+SFTP server into a S3 Bucket over several SFTP channels at once.
+All channels are opened on the one SSH transport of the handler and share
+a single S3 client (boto3 clients are thread safe), so adding workers
+costs no extra handshakes.
+Update:
+Clients, config, private keys and the SSH connection are cached at module
+level, so warm invocations of the same container skip straight to the
+transfer. Cached values are re-validated against their S3 ETag or secret
+version once CACHE_TTL_SECONDS (environment variable, default 300) passes.
+Update:
+Large files are read with a bounded window of pipelined SFTP requests and
+uploaded as S3 multipart uploads, part size and upload concurrency are
+tunable and scaled down to fit the memory of the Lambda function.
+Update:
+Progress is checkpointed to S3, one record per file. Large files are uploaded part
+by part, so a run that stops before the Lambda deadline (or times out) is
+resumed by the next invocation from the last finished part.
+Update:
+An event can carry a list of jobs (one source directory each), they run at
+the same time over one SSH connection per user. A job larger than
+"max_job_mb" is split into size-balanced shards, the extra shards are sent
+to follow-on invocations of the same function.
+Update:
+The whole handler pipeline lives here, the handlers only say where the private
+key comes from. paramiko and boto3 are imported on first use and clients are
+only built for what the event needs, set "profile_startup" in the payload or
+PROFILE_STARTUP=1 in the environment to get the time of every init step.
+'''
+
+import functools
+import hashlib
+import heapq
+import io
+import json
+import os
+import stat
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+DEFAULT_MAX_CONCURRENCY = 4
+CACHE_TTL = int(os.environ.get('CACHE_TTL_SECONDS', 300))
+MB = 1024 * 1024
+DEFAULT_PART_SIZE_MB = 16
+DEFAULT_S3_CONCURRENCY = 4
+DEFAULT_READ_AHEAD_MB = 32
+# Largest read paramiko sends in one SFTP request
+SFTP_REQUEST_SIZE = 32768
+# Seconds between checkpoint writes while parts are uploading
+CHECKPOINT_INTERVAL = 5
+# Seconds before the Lambda timeout at which no new file or part is started
+DEFAULT_STOP_MARGIN_S = 20
+# Jobs of a batch event that run at the same time
+DEFAULT_MAX_JOBS = 4
+# SFTP channels open at once on one SSH connection, OpenSSH allows 10 (MaxSessions)
+DEFAULT_MAX_CHANNELS = 8
+
+# Module level state survives between invocations of a warm container
+_clients = {}
+_cache = {}
+_ssh_clients = {}
+# Cleared once the first invocation of the container has connected
+_cold_start = True
+
+def get_client(service_name, region_name=None):
+    # boto3 clients are expensive to build, create each one once per container
+    client = _clients.get((service_name, region_name))
+    if client is None:
+        import boto3
+        client = _clients[(service_name, region_name)] = boto3.client(service_name, region_name=region_name)
+    return client
+
+def cached(name, load, version=None, ttl=None):
+    '''
+    Returns the cached value for name, calling load() -> (value, version) on a miss.
+    Once the ttl runs out, version() is compared with the cached version first
+    and the value is only reloaded if it changed.
+    '''
+    ttl = CACHE_TTL if ttl is None else ttl
+    now = time.monotonic()
+    entry = _cache.get(name)
+    if entry is not None:
+        value, cached_version, expires = entry
+        if now < expires:
+            return value
+        if version is not None and cached_version is not None and version() == cached_version:
+            _cache[name] = (value, cached_version, now + ttl)
+            return value
+
+    value, current_version = load()
+    _cache[name] = (value, current_version, now + ttl)
+    return value
+
+def load_s3_text(s3_client, bucket_name, key):
+    def load():
+        s3_object = s3_client.get_object(Bucket=bucket_name, Key=key)
+        return s3_object['Body'].read().decode('utf-8'), s3_object.get('ETag')
+
+    def version():
+        return s3_client.head_object(Bucket=bucket_name, Key=key).get('ETag')
+
+    return cached(('s3', bucket_name, key), load, version)
+
+def load_secret(secret_name, region_name):
+    client = get_client('secretsmanager', region_name)
+
+    def load():
+        response = client.get_secret_value(SecretId=secret_name)
+        return response['SecretString'], response.get('VersionId')
+
+    def version():
+        stages = client.describe_secret(SecretId=secret_name).get('VersionIdsToStages', {})
+        return next((version_id for version_id, labels in stages.items() if 'AWSCURRENT' in labels), None)
+
+    return cached(('secret', secret_name, region_name), load, version)
+
+@functools.lru_cache(maxsize=4)
+def parse_private_key(key_text):
+    # Parsing an RSA key is costly, the same key text is only parsed once
+    import paramiko
+    return paramiko.RSAKey.from_private_key(io.StringIO(key_text))
+
+def transport_is_healthy(transport):
+    # Only the local state, a connection dropped while the container was frozen still
+    # looks active, connect_checked finds those by opening a channel on it
+    return transport is not None and transport.is_active()
+
+def get_ssh_client(host, port, username, pkey, reuse=True):
+    # Reuses the SSH connection of a previous invocation when it is still alive
+    connection_key = (host, port, username)
+    ssh_client = _ssh_clients.pop(connection_key, None)
+    if ssh_client is not None:
+        if reuse and transport_is_healthy(ssh_client.get_transport()):
+            print(f"Reusing connection to {host}:{port} as {username}...")
+            _ssh_clients[connection_key] = ssh_client
+            return ssh_client
+        ssh_client.close()
+
+    import paramiko
+    ssh_client = paramiko.SSHClient()
+    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    print(f"Connecting to {host}:{port} as {username}...")
+    ssh_client.connect(hostname=host, port=port, username=username, pkey=pkey)
+    if reuse:
+        _ssh_clients[connection_key] = ssh_client
+    return ssh_client
+
+def connect_checked(host, port, username, pkey, reuse=True):
+    '''
+    Returns (ssh_client, open_channel) for a connection proven alive by opening its first
+    SFTP channel, open_channel hands that channel out first. A reused connection that
+    fails the check is dropped from the cache and replaced once.
+    '''
+    ssh_client = get_ssh_client(host, port, username, pkey, reuse)
+    try:
+        first_channel = channel_opener(ssh_client)()
+    except Exception as e:
+        print(f"Connection to {host}:{port} as {username} is dead ({e}), reconnecting...")
+        _ssh_clients.pop((host, port, username), None)
+        ssh_client.close()
+        ssh_client = get_ssh_client(host, port, username, pkey, reuse)
+        first_channel = channel_opener(ssh_client)()
+    return ssh_client, channel_opener(ssh_client, first_channel)
+
+class SFTPReadAhead:
+    '''
+    File-like reader handed to upload_fileobj. It keeps up to read_ahead bytes
+    of SFTP read requests in flight (paramiko readv pipelines them) instead of
+    one small synchronous read at a time, memory stays bounded by the window.
+    '''
+
+    def __init__(self, remote_file, size, read_ahead=DEFAULT_READ_AHEAD_MB * MB, offset=0):
+        self.remote_file = remote_file
+        self.start = offset
+        self.end = offset + size
+        self.read_ahead = max(read_ahead, SFTP_REQUEST_SIZE)
+        self.buffer = bytearray()
+        self.bytes_read = 0
+        self.chunks = self.read_windows()
+
+    def read_windows(self):
+        offset = self.start
+        while offset < self.end:
+            window_end = min(offset + self.read_ahead, self.end)
+            requests = [(start, min(SFTP_REQUEST_SIZE, window_end - start))
+                        for start in range(offset, window_end, SFTP_REQUEST_SIZE)]
+            yield from self.remote_file.readv(requests)
+            offset = window_end
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if not chunk:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.bytes_read += len(data)
+        return data
+
+def tuned_transfer(options, max_concurrency=DEFAULT_MAX_CONCURRENCY, memory_mb=None):
+    '''
+    Returns (read_ahead bytes, boto3 TransferConfig) for the options in the payload
+    or config file. Every file in flight holds its read-ahead window plus one buffer
+    per concurrent part upload, which is kept under half of the function's memory.
+    '''
+    part_size_mb = max(5, int(options.get('part_size_mb', DEFAULT_PART_SIZE_MB)))
+    s3_concurrency = max(1, int(options.get('s3_concurrency', DEFAULT_S3_CONCURRENCY)))
+    read_ahead_mb = max(1, int(options.get('read_ahead_mb', DEFAULT_READ_AHEAD_MB)))
+
+    if memory_mb is None:
+        memory_mb = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 0)) or None
+    if memory_mb:
+        budget_mb = memory_mb // 2 // max(1, int(max_concurrency))
+        while s3_concurrency > 1 and read_ahead_mb + part_size_mb * s3_concurrency > budget_mb:
+            s3_concurrency -= 1
+        read_ahead_mb = max(1, min(read_ahead_mb, budget_mb - part_size_mb * s3_concurrency))
+
+    from boto3.s3.transfer import TransferConfig
+    transfer_config = TransferConfig(multipart_threshold=part_size_mb * MB, multipart_chunksize=part_size_mb * MB,
+                                     max_concurrency=s3_concurrency, use_threads=True)
+    return read_ahead_mb * MB, transfer_config
+
+def channel_opener(ssh_client, first_channel=None):
+    # Every call opens a new SFTP channel on the existing SSH connection,
+    # except the first one when a channel is already open
+    import paramiko
+    transport = ssh_client.get_transport()
+    ready = [first_channel] if first_channel is not None else []
+
+    def open_channel():
+        try:
+            return ready.pop()
+        except IndexError:
+            return paramiko.SFTPClient.from_transport(transport)
+    return open_channel
+
+def s3_error_code(error):
+    return getattr(error, 'response', {}).get('Error', {}).get('Code')
+
+def checkpoint_key_for(host, username, source_path):
+    # S3 prefix of the checkpoint records of one SFTP source directory, shared by all its shards
+    source = f"{username}@{host}:{source_path}"
+    source_id = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    return f"checkpoints/{source_id}/"
+
+def list_keys(s3_client, bucket_name, prefix):
+    keys = []
+    kwargs = {}
+    while True:
+        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix, **kwargs)
+        keys.extend(s3_object['Key'] for s3_object in response.get('Contents', []))
+        if not response.get('IsTruncated'):
+            return keys
+        kwargs = {'ContinuationToken': response['NextContinuationToken']}
+
+class Checkpoint:
+    '''
+    Progress of one source directory stored in S3 under prefix, one small JSON record
+    per file. A file keeps its progress whichever shard it lands in, and shards running
+    at the same time only write the records of their own files.
+    "uploads" holds the multipart upload of every file in progress with its finished
+    parts, "completed" holds files that are already in S3 but not yet removed from the
+    SFTP server.
+    '''
+
+    def __init__(self, s3_client, bucket_name, prefix):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.dirty = set()
+        self.last_save = 0
+        self.parts_added = 0
+        self.uploads = {}
+        self.completed = {}
+        # Only files with progress have a record, so there are few of them to read
+        for key in list_keys(s3_client, bucket_name, prefix):
+            try:
+                s3_object = s3_client.get_object(Bucket=bucket_name, Key=key)
+            except Exception as e:
+                if s3_error_code(e) not in ('NoSuchKey', '404'):
+                    raise
+                continue
+            record = json.loads(s3_object['Body'].read().decode('utf-8'))
+            if record.get('upload'):
+                self.uploads[record['file']] = record['upload']
+            if record.get('completed'):
+                self.completed[record['file']] = record['completed']
+
+    def record_key(self, filename):
+        return f"{self.prefix}{hashlib.sha1(filename.encode('utf-8')).hexdigest()}.json"
+
+    def upload(self, filename):
+        with self.lock:
+            return self.uploads.get(filename)
+
+    def start_upload(self, filename, upload):
+        with self.lock:
+            self.uploads[filename] = upload
+            self.dirty.add(filename)
+        self.save(force=True)
+
+    def add_part(self, filename, part):
+        with self.lock:
+            self.uploads[filename]['parts'].append(part)
+            self.parts_added += 1
+            self.dirty.add(filename)
+        self.save()
+
+    def finish(self, filename, size, mtime):
+        with self.lock:
+            self.uploads.pop(filename, None)
+            self.completed[filename] = {'size': size, 'mtime': mtime}
+            self.dirty.add(filename)
+        self.save(force=True)
+
+    def is_completed(self, filename, size, mtime):
+        # Only the same file as the one uploaded counts, a replaced file is uploaded again
+        with self.lock:
+            entry = self.completed.get(filename)
+            if entry is None:
+                return False
+            if (entry.get('size'), entry.get('mtime')) == (size, mtime):
+                return True
+            del self.completed[filename]
+            self.dirty.add(filename)
+            return False
+
+    def forget(self, filename):
+        with self.lock:
+            upload = self.uploads.pop(filename, None)
+            self.completed.pop(filename, None)
+            self.dirty.add(filename)
+        return upload
+
+    def save(self, force=False):
+        with self.lock:
+            if not self.dirty or (not force and time.monotonic() - self.last_save < CHECKPOINT_INTERVAL):
+                return
+            for filename in sorted(self.dirty):
+                upload = self.uploads.get(filename)
+                completed = self.completed.get(filename)
+                if upload or completed:
+                    body = json.dumps({'file': filename, 'upload': upload, 'completed': completed})
+                    self.s3_client.put_object(Bucket=self.bucket_name, Key=self.record_key(filename),
+                                              Body=body.encode('utf-8'))
+                else:
+                    self.s3_client.delete_object(Bucket=self.bucket_name, Key=self.record_key(filename))
+            self.dirty = set()
+            self.last_save = time.monotonic()
+
+def list_uploaded_parts(s3_client, bucket_name, key, upload_id):
+    # S3 is the authority on which parts made it, even if the last checkpoint write did not
+    parts = []
+    marker = 0
+    while True:
+        response = s3_client.list_parts(Bucket=bucket_name, Key=key, UploadId=upload_id, PartNumberMarker=marker)
+        parts.extend({'PartNumber': part['PartNumber'], 'ETag': part['ETag']} for part in response.get('Parts', []))
+        if not response.get('IsTruncated'):
+            return parts
+        marker = response['NextPartNumberMarker']
+
+def abort_upload(s3_client, bucket_name, upload):
+    # An upload a lifecycle rule already aborted, or that was completed, is gone already
+    try:
+        s3_client.abort_multipart_upload(Bucket=bucket_name, Key=upload['key'], UploadId=upload['upload_id'])
+    except Exception as e:
+        if s3_error_code(e) != 'NoSuchUpload':
+            raise
+
+def upload_resumable(remote_file, filename, size, mtime, s3_client, bucket_name, key, checkpoint, part_size,
+                     s3_concurrency, read_ahead, deadline=None):
+    '''
+    Uploads one file as an S3 multipart upload recorded in the checkpoint, skipping
+    parts a previous run already finished. Returns the bytes sent, or None when the
+    deadline passed first, the upload then stays open for the next run.
+    '''
+    upload = checkpoint.upload(filename)
+    if upload is not None and ((upload['key'], upload['size'], upload.get('mtime'), upload['part_size'])
+                               != (key, size, mtime, part_size)):
+        # The file changed since the last run, start over
+        abort_upload(s3_client, bucket_name, upload)
+        checkpoint.forget(filename)
+        upload = None
+    if upload is not None:
+        try:
+            upload['parts'] = list_uploaded_parts(s3_client, bucket_name, key, upload['upload_id'])
+            print(f"Resuming {filename} after {len(upload['parts'])} finished part(s)...")
+        except Exception as e:
+            if s3_error_code(e) != 'NoSuchUpload':
+                raise
+            # Aborted by a lifecycle rule, or completed by a run stopped before its checkpoint write
+            print(f"Upload of {filename} is gone from S3, starting over...")
+            checkpoint.forget(filename)
+            upload = None
+    if upload is None:
+        upload_id = s3_client.create_multipart_upload(Bucket=bucket_name, Key=key)['UploadId']
+        upload = {'upload_id': upload_id, 'key': key, 'size': size, 'mtime': mtime, 'part_size': part_size,
+                  'parts': []}
+        checkpoint.start_upload(filename, upload)
+
+    finished = {part['PartNumber'] for part in upload['parts']}
+    part_count = max(1, -(-size // part_size))
+    bytes_sent = 0
+
+    def upload_part(part_number, body):
+        response = s3_client.upload_part(Bucket=bucket_name, Key=key, UploadId=upload['upload_id'],
+                                         PartNumber=part_number, Body=body)
+        checkpoint.add_part(filename, {'PartNumber': part_number, 'ETag': response['ETag']})
+        return len(body)
+
+    # Parts are read in order from the one SFTP file and uploaded s3_concurrency at a time
+    stopped = False
+    with ThreadPoolExecutor(max_workers=s3_concurrency) as uploads:
+        in_flight = set()
+        for part_number in range(1, part_count + 1):
+            if part_number in finished:
+                continue
+            if deadline is not None and time.monotonic() > deadline:
+                stopped = True
+                break
+            offset = (part_number - 1) * part_size
+            body = SFTPReadAhead(remote_file, min(part_size, size - offset), read_ahead, offset).read()
+            in_flight.add(uploads.submit(upload_part, part_number, body))
+            if len(in_flight) >= s3_concurrency:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                bytes_sent += sum(future.result() for future in done)
+        bytes_sent += sum(future.result() for future in in_flight)
+    checkpoint.save(force=True)
+    if stopped:
+        return None
+
+    parts = sorted(upload['parts'], key=lambda part: part['PartNumber'])
+    s3_client.complete_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload['upload_id'],
+                                        MultipartUpload={'Parts': parts})
+    checkpoint.finish(filename, size, mtime)
+    return bytes_sent
+
+def list_source_sizes(sftp_client, source_path):
+    # Only regular files are transferred, subdirectories are left alone
+    return sorted((attr.filename, attr.st_size or 0) for attr in sftp_client.listdir_attr(source_path)
+                  if attr.st_mode is None or stat.S_ISREG(attr.st_mode))
+
+def list_source_files(sftp_client, source_path):
+    return [filename for filename, size in list_source_sizes(sftp_client, source_path)]
+
+def shard_files(file_sizes, max_shard_bytes):
+    '''
+    Splits [(filename, size)] into lists of filenames of about max_shard_bytes each,
+    the largest files are placed first, each into the shard with the fewest bytes.
+    '''
+    total_bytes = sum(size for filename, size in file_sizes)
+    shard_count = max(1, min(len(file_sizes), -(-total_bytes // max(1, max_shard_bytes))))
+    shards = [(0, index, []) for index in range(shard_count)]
+    for filename, size in sorted(file_sizes, key=lambda file_size: -file_size[1]):
+        shard_bytes, index, filenames = heapq.heappop(shards)
+        filenames.append(filename)
+        heapq.heappush(shards, (shard_bytes + size, index, filenames))
+    return [sorted(filenames) for shard_bytes, index, filenames in sorted(shards, key=lambda shard: shard[1])]
+
+def job_list(event):
+    # A batch event has a "jobs" list, its other keys are defaults for every job
+    if 'jobs' not in event:
+        return [event]
+    defaults = {key: value for key, value in event.items() if key != 'jobs'}
+    return [{**defaults, **job} for job in event['jobs']]
+
+def transfer_files(open_channel, s3_client, bucket_name, source_path, dest_path,
+                   max_concurrency=DEFAULT_MAX_CONCURRENCY, filenames=None,
+                   read_ahead=DEFAULT_READ_AHEAD_MB * MB, transfer_config=None,
+                   checkpoint=None, deadline=None, source_files=None):
+    '''
+    Streams every file in source_path to s3://bucket_name/dest_path and removes it
+    from the SFTP server once uploaded. open_channel() must return a new SFTP client,
+    each worker thread opens its own. Returns one result dict per file, a failed
+    file is never removed from the source.
+    With a checkpoint, files of at least one part are uploaded resumably. Files not
+    started or finished by the deadline (a time.monotonic() value) are reported as
+    "pending" and picked up by the next run. Progress of files missing from the full
+    listing (source_files, or the listing made here) is dropped.
+    '''
+    upload_args = {'Config': transfer_config} if transfer_config is not None else {}
+    part_size = getattr(transfer_config, 'multipart_chunksize', DEFAULT_PART_SIZE_MB * MB)
+    s3_concurrency = getattr(transfer_config, 'max_concurrency', DEFAULT_S3_CONCURRENCY)
+    max_concurrency = max(1, int(max_concurrency))
+    local = threading.local()
+    channels = []
+    channels_lock = threading.Lock()
+
+    def worker_channel():
+        sftp_client = getattr(local, 'sftp_client', None)
+        if sftp_client is None:
+            sftp_client = local.sftp_client = open_channel()
+            with channels_lock:
+                channels.append(sftp_client)
+        return sftp_client
+
+    def transfer_one(filename):
+        remote_file_path = os.path.join(source_path, filename)
+        key = os.path.join(dest_path, filename)
+        start = time.monotonic()
+        if deadline is not None and start > deadline:
+            return {'file': filename, 'status': 'pending'}
+        try:
+            sftp_client = worker_channel()
+            with sftp_client.file(remote_file_path, 'rb') as remote_file:
+                file_stat = remote_file.stat()
+                size, mtime = file_stat.st_size, file_stat.st_mtime
+                if checkpoint is not None and checkpoint.is_completed(filename, size, mtime):
+                    # Uploaded by a previous run that stopped before removing it
+                    bytes_sent = 0
+                    print(f"{filename} is already in S3...")
+                else:
+                    print(f"Streaming {filename} to S3...")
+                    if checkpoint is not None and size >= part_size:
+                        bytes_sent = upload_resumable(remote_file, filename, size, mtime, s3_client, bucket_name,
+                                                      key, checkpoint, part_size, s3_concurrency, read_ahead,
+                                                      deadline)
+                        if bytes_sent is None:
+                            print(f"Stopped {filename} before the deadline, it resumes on the next run.")
+                            return {'file': filename, 'status': 'pending'}
+                    else:
+                        reader = SFTPReadAhead(remote_file, size, read_ahead)
+                        s3_client.upload_fileobj(reader, bucket_name, key, **upload_args)
+                        bytes_sent = reader.bytes_read
+            sftp_client.remove(remote_file_path)
+            if checkpoint is not None:
+                checkpoint.forget(filename)
+            seconds = time.monotonic() - start
+            mb_per_s = round(bytes_sent / MB / seconds, 2) if seconds > 0 else None
+            print(f"Transferred and removed {filename} from SFTP server ({mb_per_s} MB/s).")
+            return {'file': filename, 'status': 'transferred', 'bytes': bytes_sent,
+                    'seconds': round(seconds, 3), 'mb_per_s': mb_per_s}
+        except Exception as e:
+            print(f"Failed to transfer {filename}: {e}")
+            return {'file': filename, 'status': 'failed', 'error': str(e),
+                    'seconds': round(time.monotonic() - start, 3)}
+
+    try:
+        if filenames is None:
+            print(f"Listing files in {source_path}...")
+            filenames = source_files = list_source_files(worker_channel(), source_path)
+
+        if checkpoint is not None:
+            # Drop progress of files that are gone from the source, a shard only sees
+            # its own files so it leaves that to the run that listed the directory
+            source_set = set(source_files) if source_files is not None else None
+            for filename in set(checkpoint.uploads) | set(checkpoint.completed):
+                if source_set is not None and filename not in source_set:
+                    upload = checkpoint.forget(filename)
+                    if upload is not None:
+                        abort_upload(s3_client, bucket_name, upload)
+            # Finish what a previous run started first, then go in name order
+            filenames = sorted(filenames, key=lambda filename: (filename not in checkpoint.uploads
+                                                                and filename not in checkpoint.completed, filename))
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+            return list(pool.map(transfer_one, filenames))
+    finally:
+        if checkpoint is not None:
+            checkpoint.save(force=True)
+        for sftp_client in channels:
+            sftp_client.close()
+
+def summarize(results):
+    failed = [result['file'] for result in results if result['status'] == 'failed']
+    pending = [result['file'] for result in results if result['status'] == 'pending']
+    transferred_bytes = sum(result.get('bytes', 0) for result in results)
+    return {
+        'transferred': len(results) - len(failed) - len(pending),
+        'failed': failed,
+        'pending': pending,
+        'bytes': transferred_bytes,
+    }
+
+def job_status(summary):
+    if summary['pending']:
+        return 202
+    if summary['failed']:
+        return 207
+    return 200
+
+def invoke_follow_on(lambda_client, function_name, job):
+    # Asynchronous invocation of the same function with a single-job event
+    lambda_client.invoke(FunctionName=function_name, InvocationType='Event',
+                         Payload=json.dumps(job).encode('utf-8'))
+
+def transfer_job(job, config, open_channel, s3_client, bucket_name, host, context=None, deadline=None,
+                 lambda_client=None, parallel_jobs=1, max_channels=None):
+    '''
+    Runs one job (source_path, dest_path, username, optional "files" and "shard") with
+    the options of the job over the config file, on at most max_channels SFTP channels
+    of the shared SSH connection. When "max_job_mb" is set and the job is
+    larger, it is sharded and every shard but the first is sent to a follow-on invocation,
+    as are the files of a shard still pending at the deadline. Returns the job's result.
+    '''
+    options = {**config, **job}
+    source_path = job['source_path']
+    username = job['username']
+    shard = job.get('shard')
+    function_name = getattr(context, 'function_name', None) if lambda_client is not None else None
+
+    filenames = job.get('files')
+    source_files = None
+    shards_dispatched = 0
+    if filenames is None:
+        sftp_client = open_channel()
+        try:
+            file_sizes = list_source_sizes(sftp_client, source_path)
+        finally:
+            sftp_client.close()
+        filenames = source_files = [filename for filename, size in file_sizes]
+        if options.get('max_job_mb') and function_name:
+            shards = shard_files(file_sizes, int(options['max_job_mb'] * MB))
+            filenames = shards[0]
+            shard = 0 if len(shards) > 1 else None
+            for index, shard_filenames in enumerate(shards[1:], 1):
+                invoke_follow_on(lambda_client, function_name, {**job, 'files': shard_filenames, 'shard': index})
+            shards_dispatched = len(shards) - 1
+            if shards_dispatched:
+                print(f"Sent {shards_dispatched} shard(s) of {source_path} to follow-on invocations...")
+
+    max_concurrency = int(options.get('max_concurrency', DEFAULT_MAX_CONCURRENCY))
+    if max_channels:
+        max_concurrency = max(1, min(max_concurrency, max_channels))
+    read_ahead, transfer_config = tuned_transfer(options, int(max_concurrency) * max(1, parallel_jobs))
+
+    # Checkpoint progress to S3 and stop before the Lambda timeout,
+    # the next invocation resumes where this one stopped
+    checkpoint = None
+    if options.get('resumable', True):
+        # One prefix for the whole job, so a file keeps its progress when it moves to another shard
+        checkpoint_key = options.get('checkpoint_key') or checkpoint_key_for(host, username, source_path)
+        checkpoint = Checkpoint(s3_client, bucket_name, checkpoint_key.rstrip('/') + '/')
+    results = transfer_files(open_channel, s3_client, bucket_name, source_path, job['dest_path'],
+                             max_concurrency, filenames=filenames, read_ahead=read_ahead,
+                             transfer_config=transfer_config, checkpoint=checkpoint, deadline=deadline,
+                             source_files=source_files)
+    summary = summarize(results)
+
+    # Nobody waits for a shard, so it continues its own pending files. Only after some progress,
+    # a shard that can't get anywhere before the deadline would re-invoke itself forever
+    if job.get('files') is not None and summary['pending'] and function_name and checkpoint is not None:
+        if summary['transferred'] or checkpoint.parts_added:
+            invoke_follow_on(lambda_client, function_name, {**job, 'files': summary['pending'], 'shard': shard})
+            shards_dispatched += 1
+        else:
+            print(f"No progress on {source_path} before the deadline, {len(summary['pending'])} file(s) "
+                  f"are left for the next run...")
+
+    result = {'source_path': source_path, 'dest_path': job['dest_path'], 'username': username,
+              'statusCode': job_status(summary), 'summary': summary, 'results': results}
+    if shard is not None:
+        result['shard'] = shard
+    if shards_dispatched:
+        result['shards_dispatched'] = shards_dispatched
+    return result
+
+def run_jobs(jobs, run_job, max_jobs=DEFAULT_MAX_JOBS):
+    # Runs run_job(job) for every job, max_jobs at a time, a failing job doesn't stop the others
+    def run_one(job):
+        try:
+            return run_job(job)
+        except Exception as e:
+            print(f"Job {job.get('source_path')} failed: {e}")
+            return {'source_path': job.get('source_path'), 'dest_path': job.get('dest_path'),
+                    'username': job.get('username'), 'statusCode': 500, 'error': str(e)}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(int(max_jobs), len(jobs) or 1))) as pool:
+        return list(pool.map(run_one, jobs))
+
+def channel_shares_per_job(jobs, max_jobs, max_channels):
+    # Jobs of one user share its SSH connection, each gets an equal share of max_channels
+    jobs_per_user = {}
+    for job in jobs:
+        jobs_per_user[job['username']] = jobs_per_user.get(job['username'], 0) + 1
+    return {username: max(1, max_channels // max(1, min(max_jobs, count)))
+            for username, count in jobs_per_user.items()}
+
+def invocation_deadline(context, stop_margin_s):
+    # time.monotonic() value to stop starting new work at, None without a Lambda context
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - stop_margin_s
+
+def startup_profiling(options):
+    return bool(options.get('profile_startup')) or os.environ.get('PROFILE_STARTUP', '').lower() in ('1', 'true', 'yes')
+
+def timed_step(timings, name, load):
+    # Runs load() and records how long it took, lazy imports show up in the first call
+    start = time.perf_counter()
+    value = load()
+    timings[name] = round(time.perf_counter() - start, 4)
+    return value
+
+def job_response(event, jobs, job_results):
+    # Single-job events keep their original response, batch events report every job
+    statuses = [job_result['statusCode'] for job_result in job_results]
+    if 'jobs' not in event:
+        job_result = job_results[0]
+        if job_result['statusCode'] == 500:
+            raise Exception(job_result['error'])
+        body = {
+            202: f"SFTP file transfer stopped before the timeout with {len(job_result['summary']['pending'])} pending file(s)",
+            207: f"SFTP file transfer completed with {len(job_result['summary']['failed'])} failed file(s)",
+            200: 'SFTP file transfer completed successfully',
+        }[job_result['statusCode']]
+        return {'statusCode': job_result['statusCode'], 'body': body, 'results': job_result['results']}
+    status_code = 207 if any(status in (207, 500) for status in statuses) else max(statuses, default=200)
+    return {
+        'statusCode': status_code,
+        'body': f"SFTP batch transfer of {len(jobs)} job(s) completed, {statuses.count(200)} fully transferred",
+        'jobs': job_results,
+    }
+
+def handle_event(event, context, bucket_name, config_key, load_private_key):
+    '''
+    The pipeline of both handlers: reads the config file from S3, gets the key text from
+    load_private_key(options, s3_client), connects once per user as its first job starts
+    and runs every job.
+    Returns the response dict, a failed single-job event raises its error.
+    '''
+    global _cold_start
+    cold_start = _cold_start
+    modules_before = len(sys.modules)
+    timings = {}
+
+    # Read the jobs (source path, dest path and username) from event payload
+    jobs = job_list(event)
+
+    # S3 client, reused by warm invocations
+    s3_client = timed_step(timings, 's3_client', lambda: get_client('s3'))
+
+    # Stream the JSON file from S3, cached until its ETag changes
+    config = json.loads(timed_step(timings, 'config', lambda: load_s3_text(s3_client, bucket_name, config_key)))
+    host = config['host']
+    port = config.get('port', 22)  # Default to port 22 if not specified
+    options = {**config, **event}
+
+    # Print the loaded configuration
+    print(f"Loaded config from S3: {json.dumps(config, indent=2)}")
+
+    # The key text is parsed once per container
+    pem_key = timed_step(timings, 'private_key', lambda: parse_private_key(load_private_key(options, s3_client)))
+
+    # Connect to the SFTP server once per user, or reuse the live connections of a warm container.
+    # The first job of a user connects and its other jobs wait for it, a user whose connection
+    # fails only fails its own jobs
+    reuse_connection = options.get('reuse_connection', True)
+    ssh_clients = {}
+    connect_errors = {}
+    user_locks = {username: threading.Lock() for username in {job['username'] for job in jobs}}
+    timings_lock = threading.Lock()
+    timings['connect'] = 0
+
+    def ssh_client_for(username):
+        with user_locks[username]:
+            if username in connect_errors:
+                raise connect_errors[username]
+            if username not in ssh_clients:
+                start = time.perf_counter()
+                try:
+                    ssh_clients[username] = connect_checked(host, port, username, pem_key, reuse_connection)
+                except Exception as e:
+                    connect_errors[username] = e
+                    raise
+                finally:
+                    with timings_lock:
+                        timings['connect'] = round(timings['connect'] + time.perf_counter() - start, 4)
+            ssh_client, open_channel = ssh_clients[username]
+            return open_channel
+    _cold_start = False
+
+    # Transfer the files of every job directly to S3, jobs run at the same time and
+    # every worker opens its own SFTP channel on the connection of the job's user.
+    # Progress is checkpointed to S3 and the run stops before the Lambda timeout,
+    # the next invocation resumes where this one stopped
+    deadline = invocation_deadline(context, options.get('stop_margin_s', DEFAULT_STOP_MARGIN_S))
+    lambda_client = get_client('lambda') if options.get('max_job_mb') else None
+    # Every running job holds at least one channel, so no more jobs than channels run at once
+    max_channels = int(options.get('max_channels', DEFAULT_MAX_CHANNELS))
+    max_jobs = max(1, min(int(options.get('max_jobs', DEFAULT_MAX_JOBS)), max_channels))
+    channel_shares = channel_shares_per_job(jobs, max_jobs, max_channels)
+    job_results = timed_step(timings, 'transfer', lambda: run_jobs(jobs, lambda job: transfer_job(
+        job, config, ssh_client_for(job['username']), s3_client, bucket_name, host, context,
+        deadline, lambda_client, min(max_jobs, len(jobs)), channel_shares[job['username']]), max_jobs))
+
+    # Close the SSH connections unless they are kept for the next invocation
+    if not reuse_connection:
+        for ssh_client, open_channel in ssh_clients.values():
+            ssh_client.close()
+
+    # Format the output response, failed files are left on the SFTP server
+    response = job_response(event, jobs, job_results)
+    if startup_profiling(options):
+        # Connecting happens as the jobs start, so it is part of the transfer time too
+        init_seconds = sum(seconds for step, seconds in timings.items() if step != 'transfer')
+        profile = {'cold_start': cold_start, 'init_seconds': round(init_seconds, 4), 'steps': timings,
+                   'modules_loaded': len(sys.modules) - modules_before}
+        print(f"Startup profile: {json.dumps(profile, sort_keys=True)}")
+        response['startup'] = profile
+    return response
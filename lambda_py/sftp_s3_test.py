@@ -0,0 +1,472 @@
+'''
+This is a testing file for sftp_s3.py
+The SFTP server and S3 Bucket are replaced by local stand-ins,
+so the transfer engine can be tested without an AWS account
+'''
+
+import unittest
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+from unittest.mock import patch, Mock
+import sftp_s3
+from sftp_s3 import transfer_files, summarize, cached, SFTPReadAhead, Checkpoint, shard_files, job_list, run_jobs
+from sftp_s3 import handle_event, channel_shares_per_job, connect_checked, transfer_job
+
+class LocalSFTP:
+    # Stand-in for a paramiko SFTPClient serving files from a local directory,
+    # the paths of files opened for writing are recorded in written
+    def __init__(self, root, written=None):
+        self.root = root
+        self.written = [] if written is None else written
+        self.closed = False
+
+    def local(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def listdir_attr(self, path):
+        attrs = []
+        for entry in os.scandir(self.local(path)):
+            attr = type('SFTPAttributes', (), {})()
+            attr.filename = entry.name
+            attr.st_mode = entry.stat().st_mode
+            attr.st_size = entry.stat().st_size
+            attr.st_mtime = int(entry.stat().st_mtime)
+            attrs.append(attr)
+        return attrs
+
+    def file(self, path, mode='rb'):
+        return LocalSFTPFile(self.local(path), mode)
+
+    def open(self, path, mode='rb'):
+        if 'r' not in mode:
+            self.written.append(path)
+        return self.file(path, mode)
+
+    def mkdir(self, path):
+        os.mkdir(self.local(path))
+
+    def posix_rename(self, old_path, new_path):
+        os.replace(self.local(old_path), self.local(new_path))
+
+    def utime(self, path, times):
+        os.utime(self.local(path), times)
+
+    def remove(self, path):
+        os.remove(self.local(path))
+
+    def close(self):
+        self.closed = True
+
+class LocalSFTPFile:
+    # Stand-in for a paramiko SFTPFile, readv records the size of every read window
+    def __init__(self, path, mode):
+        self.file = open(path, mode)
+        self.windows = []
+
+    def stat(self):
+        return os.fstat(self.file.fileno())
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+    def write(self, data):
+        self.file.write(data)
+
+    def readv(self, chunks):
+        self.windows.append(sum(length for offset, length in chunks))
+        for offset, length in chunks:
+            self.file.seek(offset)
+            yield self.file.read(length)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+class NoSuchKey(Exception):
+    response = {'Error': {'Code': 'NoSuchKey'}}
+
+class NoSuchUpload(Exception):
+    response = {'Error': {'Code': 'NoSuchUpload'}}
+
+class LocalS3:
+    # Stand-in for a boto3 S3 client keeping uploaded objects and multipart uploads in memory
+    def __init__(self, fail_keys=(), fail_parts=()):
+        self.objects = {}
+        self.fail_keys = set(fail_keys)
+        self.fail_parts = set(fail_parts)
+        self.uploads = {}
+        self.uploaded_parts = []
+        self.lock = threading.Lock()
+
+    def upload_fileobj(self, fileobj, bucket, key, **kwargs):
+        data = b"".join(iter(lambda: fileobj.read(8192), b""))
+        if key in self.fail_keys:
+            raise IOError(f"upload of {key} failed")
+        with self.lock:
+            self.objects[(bucket, key)] = data
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body):
+        with self.lock:
+            self.objects[(Bucket, Key)] = Body
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None):
+        keys = sorted(key for bucket, key in list(self.objects) if bucket == Bucket and key.startswith(Prefix))
+        return {'Contents': [{'Key': key} for key in keys], 'IsTruncated': False}
+
+    def delete_object(self, Bucket, Key):
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber in self.fail_parts:
+            self.fail_parts.discard(PartNumber)
+            raise IOError(f"upload of part {PartNumber} failed")
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = Body
+            self.uploaded_parts.append(PartNumber)
+        return {'ETag': f"etag-{PartNumber}"}
+
+    def list_parts(self, Bucket, Key, UploadId, PartNumberMarker=0):
+        if UploadId not in self.uploads:
+            raise NoSuchUpload(UploadId)
+        parts = [{'PartNumber': number, 'ETag': f"etag-{number}"} for number in sorted(self.uploads[UploadId])]
+        return {'Parts': parts, 'IsTruncated': False}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        numbers = [part['PartNumber'] for part in MultipartUpload['Parts']]
+        self.objects[(Bucket, Key)] = b"".join(parts[number] for number in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        if self.uploads.pop(UploadId, None) is None:
+            raise NoSuchUpload(UploadId)
+
+class LocalTransferConfig:
+    # Stand-in for a boto3 TransferConfig with tiny parts
+    multipart_chunksize = 1000
+    max_concurrency = 2
+
+class TestTransferFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.sftp_root = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.sftp_root, "source_dir")
+        os.makedirs(os.path.join(self.source_dir, "subdir"))
+        for i in range(10):
+            with open(os.path.join(self.source_dir, f"file{i}.txt"), "w") as f:
+                f.write(f"content{i}\n")
+        self.channels = []
+
+    def tearDown(self):
+        shutil.rmtree(self.sftp_root)
+
+    def open_channel(self):
+        channel = LocalSFTP(self.sftp_root)
+        self.channels.append(channel)
+        return channel
+
+    def test_transfers_all_files_concurrently(self):
+        s3_client = LocalS3()
+        results = transfer_files(self.open_channel, s3_client, "bucket", "/source_dir", "dest/", max_concurrency=4)
+
+        self.assertEqual(summarize(results), {'transferred': 10, 'failed': [], 'pending': [], 'bytes': 90})
+        self.assertEqual(s3_client.objects[("bucket", "dest/file3.txt")], b"content3\n")
+        self.assertEqual(os.listdir(self.source_dir), ["subdir"])
+        self.assertLessEqual(len(self.channels), 5)
+        self.assertTrue(all(channel.closed for channel in self.channels))
+
+    def test_failed_file_stays_on_source(self):
+        s3_client = LocalS3(fail_keys={"dest/file5.txt"})
+        results = transfer_files(self.open_channel, s3_client, "bucket", "/source_dir", "dest/", max_concurrency=3)
+
+        self.assertEqual(summarize(results)['failed'], ["file5.txt"])
+        self.assertTrue(os.path.exists(os.path.join(self.source_dir, "file5.txt")))
+        self.assertFalse(os.path.exists(os.path.join(self.source_dir, "file4.txt")))
+
+class TestResumableTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.sftp_root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.sftp_root, "source_dir"))
+        self.large_file = os.path.join(self.sftp_root, "source_dir", "large.bin")
+        self.data = os.urandom(5500)
+        with open(self.large_file, "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.sftp_root)
+
+    def transfer(self, s3_client, deadline=None):
+        checkpoint = Checkpoint(s3_client, "bucket", "checkpoints/test/")
+        return transfer_files(lambda: LocalSFTP(self.sftp_root), s3_client, "bucket", "/source_dir", "dest/",
+                              transfer_config=LocalTransferConfig(), checkpoint=checkpoint, deadline=deadline)
+
+    def checkpoint_records(self, s3_client):
+        return [key for bucket, key in s3_client.objects if key.startswith("checkpoints/test/")]
+
+    def test_progress_follows_a_file_into_another_shard(self):
+        s3_client = LocalS3(fail_parts={4})
+        self.transfer(s3_client)
+        first_run = set(s3_client.uploaded_parts)
+        s3_client.uploaded_parts = []
+
+        # A shard listing only large.bin picks up the parts finished under the whole job
+        checkpoint = Checkpoint(s3_client, "bucket", "checkpoints/test/")
+        results = transfer_files(lambda: LocalSFTP(self.sftp_root), s3_client, "bucket", "/source_dir", "dest/",
+                                 filenames=["large.bin"], transfer_config=LocalTransferConfig(), checkpoint=checkpoint)
+        self.assertEqual(summarize(results)['transferred'], 1)
+        self.assertFalse(first_run & set(s3_client.uploaded_parts))
+        self.assertEqual(s3_client.objects[("bucket", "dest/large.bin")], self.data)
+
+    def test_failed_upload_resumes_from_finished_parts(self):
+        s3_client = LocalS3(fail_parts={4})
+        self.assertEqual(summarize(self.transfer(s3_client))['failed'], ["large.bin"])
+        self.assertTrue(os.path.exists(self.large_file))
+        first_run = set(s3_client.uploaded_parts)
+        self.assertTrue(self.checkpoint_records(s3_client))
+
+        s3_client.uploaded_parts = []
+        self.assertEqual(summarize(self.transfer(s3_client))['transferred'], 1)
+        self.assertFalse(first_run & set(s3_client.uploaded_parts))
+        self.assertEqual(s3_client.objects[("bucket", "dest/large.bin")], self.data)
+        self.assertFalse(os.path.exists(self.large_file))
+        self.assertFalse(self.checkpoint_records(s3_client))
+
+    def test_replaced_file_is_not_taken_for_a_completed_one(self):
+        s3_client = LocalS3()
+        s3_client.objects[("bucket", "checkpoints/test/stale.json")] = b'{"file": "large.bin", "completed": {"size": 100}}'
+        self.assertEqual(summarize(self.transfer(s3_client))['transferred'], 1)
+        self.assertEqual(s3_client.objects[("bucket", "dest/large.bin")], self.data)
+
+    def test_upload_of_a_replaced_file_starts_over(self):
+        s3_client = LocalS3(fail_parts={4})
+        self.transfer(s3_client)
+        new_data = os.urandom(len(self.data))
+        with open(self.large_file, "wb") as f:
+            f.write(new_data)
+        os.utime(self.large_file, (1700000000, 1700000000))
+
+        self.assertEqual(summarize(self.transfer(s3_client))['transferred'], 1)
+        self.assertEqual(s3_client.objects[("bucket", "dest/large.bin")], new_data)
+
+    def test_upload_gone_from_s3_starts_over(self):
+        s3_client = LocalS3(fail_parts={4})
+        self.transfer(s3_client)
+        # A lifecycle rule aborts the upload between runs
+        s3_client.uploads.clear()
+        self.assertEqual(summarize(self.transfer(s3_client))['transferred'], 1)
+        self.assertEqual(s3_client.objects[("bucket", "dest/large.bin")], self.data)
+        self.assertFalse(self.checkpoint_records(s3_client))
+
+    def test_gone_upload_of_a_replaced_file_starts_over(self):
+        s3_client = LocalS3(fail_parts={4})
+        self.transfer(s3_client)
+        s3_client.uploads.clear()
+        new_data = os.urandom(len(self.data))
+        with open(self.large_file, "wb") as f:
+            f.write(new_data)
+        os.utime(self.large_file, (1700000000, 1700000000))
+
+        self.assertEqual(summarize(self.transfer(s3_client))['transferred'], 1)
+        self.assertEqual(s3_client.objects[("bucket", "dest/large.bin")], new_data)
+
+    def test_passed_deadline_leaves_files_pending(self):
+        s3_client = LocalS3()
+        results = self.transfer(s3_client, deadline=0)
+        self.assertEqual(summarize(results)['pending'], ["large.bin"])
+        self.assertTrue(os.path.exists(self.large_file))
+
+    @patch('sftp_s3.tuned_transfer', return_value=(1000, LocalTransferConfig()))
+    def test_shard_without_progress_does_not_reinvoke_itself(self, mock_tuned_transfer):
+        s3_client = LocalS3()
+        lambda_client = Mock()
+        context = Mock(function_name="sftp-to-s3")
+        job = {'source_path': '/source_dir', 'dest_path': 'dest/', 'username': 'ec2-user', 'files': ["large.bin"],
+               'shard': 1, 'checkpoint_key': 'checkpoints/test/'}
+        result = transfer_job(job, {}, lambda: LocalSFTP(self.sftp_root), s3_client, "bucket", "sftp.example.com",
+                              context, 0, lambda_client)
+        self.assertEqual(result['summary']['pending'], ["large.bin"])
+        lambda_client.invoke.assert_not_called()
+        self.assertNotIn('shards_dispatched', result)
+
+class TestJobs(unittest.TestCase):
+
+    def test_shard_files_balances_bytes(self):
+        file_sizes = [("a", 400), ("b", 300), ("c", 200), ("d", 100), ("e", 100)]
+        shards = shard_files(file_sizes, 400)
+        self.assertEqual(len(shards), 3)
+        self.assertEqual(sorted(sum(shards, [])), ["a", "b", "c", "d", "e"])
+        sizes = dict(file_sizes)
+        self.assertLessEqual(max(sum(sizes[name] for name in shard) for shard in shards), 400)
+
+    def test_job_list_applies_batch_defaults(self):
+        event = {'username': 'ec2-user', 'max_concurrency': 2,
+                 'jobs': [{'source_path': '/a', 'dest_path': 'a/'}, {'source_path': '/b', 'dest_path': 'b/', 'username': 'other'}]}
+        jobs = job_list(event)
+        self.assertEqual([job['username'] for job in jobs], ['ec2-user', 'other'])
+        self.assertTrue(all(job['max_concurrency'] == 2 for job in jobs))
+        self.assertEqual(job_list({'source_path': '/a'}), [{'source_path': '/a'}])
+
+    def test_jobs_of_one_user_share_the_channel_limit(self):
+        jobs = [{'username': 'a'}] * 4 + [{'username': 'b'}]
+        self.assertEqual(channel_shares_per_job(jobs, 4, 8), {'a': 2, 'b': 8})
+        self.assertEqual(channel_shares_per_job(jobs, 2, 8), {'a': 4, 'b': 8})
+        self.assertEqual(channel_shares_per_job([{'username': 'a'}] * 16, 8, 8), {'a': 1})
+
+    def test_failing_job_does_not_stop_the_others(self):
+        def run_job(job):
+            if job['source_path'] == '/bad':
+                raise IOError("no such directory")
+            return {'source_path': job['source_path'], 'statusCode': 200}
+
+        results = run_jobs([{'source_path': '/a'}, {'source_path': '/bad'}, {'source_path': '/c'}], run_job, max_jobs=2)
+        self.assertEqual([result['statusCode'] for result in results], [200, 500, 200])
+        self.assertEqual(results[1]['error'], "no such directory")
+
+class TestHandleEvent(unittest.TestCase):
+
+    def setUp(self):
+        self.sftp_root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.sftp_root, "source_dir"))
+        for i in range(3):
+            with open(os.path.join(self.sftp_root, "source_dir", f"file{i}.txt"), "w") as f:
+                f.write(f"content{i}\n")
+        self.s3_client = LocalS3()
+        config = {'host': 'sftp.example.com', 'key_path': 'keys/key.pem', 'resumable': False}
+        self.s3_client.objects[("bucket", "config.json")] = json.dumps(config).encode('utf-8')
+
+    def tearDown(self):
+        shutil.rmtree(self.sftp_root)
+
+    @patch('sftp_s3.tuned_transfer', return_value=(1000, LocalTransferConfig()))
+    @patch('sftp_s3.channel_opener')
+    @patch('sftp_s3.get_ssh_client')
+    @patch('sftp_s3.parse_private_key')
+    @patch('sftp_s3.get_client')
+    def test_pipeline_only_builds_what_the_event_needs(self, mock_get_client, mock_parse_private_key,
+                                                       mock_get_ssh_client, mock_channel_opener, mock_tuned_transfer):
+        mock_get_client.return_value = self.s3_client
+        mock_channel_opener.return_value = lambda: LocalSFTP(self.sftp_root)
+        event = {'source_path': '/source_dir', 'dest_path': 'dest/', 'username': 'ec2-user', 'profile_startup': True}
+
+        response = handle_event(event, None, "bucket", "config.json", lambda options, s3_client: "key text")
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(len(response['results']), 3)
+        mock_parse_private_key.assert_called_once_with("key text")
+        mock_get_client.assert_called_once_with('s3')  # No Lambda client without max_job_mb
+        self.assertEqual(sorted(response['startup']['steps']), ['config', 'connect', 'private_key', 's3_client', 'transfer'])
+
+    @patch('sftp_s3.tuned_transfer', return_value=(1000, LocalTransferConfig()))
+    @patch('sftp_s3.channel_opener')
+    @patch('sftp_s3.get_ssh_client')
+    @patch('sftp_s3.parse_private_key')
+    @patch('sftp_s3.get_client')
+    def test_failed_connection_only_fails_that_users_jobs(self, mock_get_client, mock_parse_private_key,
+                                                          mock_get_ssh_client, mock_channel_opener, mock_tuned_transfer):
+        mock_get_client.return_value = self.s3_client
+        mock_channel_opener.return_value = lambda: LocalSFTP(self.sftp_root)
+
+        def connect(host, port, username, pkey, reuse):
+            if username == "bad-user":
+                raise IOError("Authentication failed")
+            return object()
+        mock_get_ssh_client.side_effect = connect
+        event = {'jobs': [{'source_path': '/source_dir', 'dest_path': 'dest/', 'username': 'bad-user'},
+                          {'source_path': '/source_dir', 'dest_path': 'other/', 'username': 'ec2-user'}]}
+
+        response = handle_event(event, None, "bucket", "config.json", lambda options, s3_client: "key text")
+        self.assertEqual(response['statusCode'], 207)
+        self.assertEqual([job['statusCode'] for job in response['jobs']], [500, 200])
+        self.assertEqual(response['jobs'][0]['error'], "Authentication failed")
+        self.assertEqual(len(response['jobs'][1]['results']), 3)
+
+class TestConnection(unittest.TestCase):
+
+    def tearDown(self):
+        sftp_s3._ssh_clients.clear()
+
+    @patch('sftp_s3.channel_opener')
+    @patch('sftp_s3.get_ssh_client')
+    def test_dead_cached_connection_is_replaced(self, mock_get_ssh_client, mock_channel_opener):
+        # The cached client looks active, but opening a channel on it fails
+        dead_client = Mock(dead=True)
+        live_client = Mock(dead=False)
+        sftp_s3._ssh_clients[("sftp.example.com", 22, "ec2-user")] = dead_client
+        mock_get_ssh_client.side_effect = [dead_client, live_client]
+
+        def opener(ssh_client, first_channel=None):
+            def open_channel():
+                if ssh_client.dead:
+                    raise EOFError("channel closed")
+                return first_channel or "channel"
+            return open_channel
+        mock_channel_opener.side_effect = opener
+
+        ssh_client, open_channel = connect_checked("sftp.example.com", 22, "ec2-user", "key")
+        self.assertIs(ssh_client, live_client)
+        self.assertEqual(open_channel(), "channel")
+        dead_client.close.assert_called_once()
+        self.assertNotIn(("sftp.example.com", 22, "ec2-user"), sftp_s3._ssh_clients)
+        self.assertEqual(mock_get_ssh_client.call_count, 2)
+
+class TestSFTPReadAhead(unittest.TestCase):
+
+    def test_reads_whole_file_in_bounded_windows(self):
+        data = os.urandom(200000)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            remote_file = LocalSFTPFile(f.name, 'rb')
+            reader = SFTPReadAhead(remote_file, len(data), read_ahead=65536)
+            self.assertEqual(b"".join(iter(lambda: reader.read(50000), b"")), data)
+            remote_file.file.close()
+
+        self.assertEqual(reader.bytes_read, len(data))
+        self.assertTrue(all(window <= 65536 for window in remote_file.windows))
+
+class TestCached(unittest.TestCase):
+
+    def setUp(self):
+        sftp_s3._cache.clear()
+        self.loads = 0
+        self.current_version = "v1"
+
+    def load(self):
+        self.loads += 1
+        return f"value-{self.current_version}", self.current_version
+
+    def version(self):
+        return self.current_version
+
+    def test_value_is_reused_while_fresh(self):
+        self.assertEqual(cached("config", self.load, self.version, ttl=60), "value-v1")
+        self.assertEqual(cached("config", self.load, self.version, ttl=60), "value-v1")
+        self.assertEqual(self.loads, 1)
+
+    def test_expired_value_is_only_reloaded_when_version_changes(self):
+        cached("config", self.load, self.version, ttl=0)
+        self.assertEqual(cached("config", self.load, self.version, ttl=0), "value-v1")
+        self.assertEqual(self.loads, 1)
+
+        self.current_version = "v2"
+        self.assertEqual(cached("config", self.load, self.version, ttl=0), "value-v2")
+        self.assertEqual(self.loads, 2)
+
+if __name__ == '__main__':
+    unittest.main()